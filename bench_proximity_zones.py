@@ -0,0 +1,170 @@
+"""
+benchmarks.proximity_zones
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Benchmarks for the proximity_zones component.
+
+Run with: python bench_proximity_zones.py
+"""
+
+import random
+import tracemalloc
+import homeassistant.core as ha
+from homeassistant.components import proximity_zones
+
+# number of devices and ignored zones in the benchmark proximity
+BENCH_DEVICES = 50
+BENCH_ZONES = 30
+
+# number of proximity entities and devices per entity in the memory benchmark
+BENCH_MEMORY_ENTITIES = (1000, 10000)
+BENCH_MEMORY_DEVICES = 5
+
+
+class DictLayout(object):
+    """ Object that keeps its attributes in an instance dictionary. """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, values):
+        for name, value in values:
+            setattr(self, name, value)
+
+
+def setup_bench_home_assistant(zones, devices):
+    """ Create a Home Assistant instance with zones and devices. """
+    hass = ha.HomeAssistant()
+    rand = random.Random(0)
+
+    for index in range(zones):
+        # half of the ignored zones are inside the monitored zone
+        if index % 2:
+            latitude = 2.1 + rand.uniform(-0.2, 0.2)
+            longitude = 1.1 + rand.uniform(-0.2, 0.2)
+        else:
+            latitude = rand.uniform(-60, 60)
+            longitude = rand.uniform(-180, 180)
+        hass.states.set('zone.bench' + str(index), 'zoning', {
+            'friendly_name': 'bench' + str(index),
+            'latitude': latitude,
+            'longitude': longitude,
+            'radius': rand.uniform(100, 1000)
+        })
+    hass.states.set('zone.home', 'zoning', {
+        'friendly_name': 'home',
+        'latitude': 2.1,
+        'longitude': 1.1,
+        'radius': 50000
+    })
+
+    for index in range(devices):
+        # half of the devices are around the monitored zone
+        if index % 2:
+            latitude = 2.1 + rand.uniform(-0.5, 0.5)
+            longitude = 1.1 + rand.uniform(-0.5, 0.5)
+        else:
+            latitude = rand.uniform(-60, 60)
+            longitude = rand.uniform(-180, 180)
+        hass.states.set('device_tracker.bench' + str(index), 'not_home', {
+            'friendly_name': 'bench' + str(index),
+            'latitude': latitude,
+            'longitude': longitude
+        })
+
+    return hass
+
+
+def create_bench_proximity(hass, zones, devices):
+    """ Create a proximity tracking all the benchmark devices. """
+    proximity = proximity_zones.Proximity(
+        hass, 'home', 'not set', 'not set', 'not set',
+        ['bench' + str(index) for index in range(zones)],
+        ['device_tracker.bench' + str(index) for index in range(devices)],
+        1, 'zone.home', 'home')
+    proximity.entity_id = 'proximity_zones.bench'
+    return proximity
+
+
+def count_zone_checks(proximity):
+    """ Count the exact zone checks made to locate every device. """
+    proximity.zone_checks = 0
+    proximity.rebuild_device_cache()
+    return proximity.zone_checks
+
+
+def bench_zone_checks():
+    """ Count the exact zone checks with and without the prefilters. """
+    hass = setup_bench_home_assistant(BENCH_ZONES, BENCH_DEVICES)
+    in_bounding_box = proximity_zones.in_bounding_box
+    try:
+        proximity = create_bench_proximity(hass, BENCH_ZONES, BENCH_DEVICES)
+        with_index = count_zone_checks(proximity)
+
+        proximity.zone_index = None
+        with_prefilters = count_zone_checks(proximity)
+
+        proximity_zones.in_bounding_box = lambda *args: True
+        with_relations = count_zone_checks(proximity)
+
+        proximity.zones_inside = dict.fromkeys(proximity.zones_inside,
+                                               frozenset())
+        without_prefilters = count_zone_checks(proximity)
+    finally:
+        proximity_zones.in_bounding_box = in_bounding_box
+        hass.stop()
+
+    print('zone checks: {} devices, {} ignored zones'.format(
+        BENCH_DEVICES, BENCH_ZONES))
+    print('  without prefilters:  {}'.format(without_prefilters))
+    print('  with zone relations: {}'.format(with_relations))
+    print('  with bounding boxes: {}'.format(with_prefilters))
+    print('  with spatial index:  {}'.format(with_index))
+
+
+def slot_values(obj):
+    """ Names and values of the slots of an object. """
+    return [(name, getattr(obj, name)) for name in type(obj).__slots__]
+
+
+def slots_copy(obj):
+    """ Copy an object that keeps its attributes in slots. """
+    copy = object.__new__(type(obj))
+    for name, value in slot_values(obj):
+        setattr(copy, name, value)
+    return copy
+
+
+def layout_bytes(layout, objects):
+    """ Bytes allocated to lay out copies of the objects. """
+    tracemalloc.start()
+    copies = [layout(obj) for obj in objects]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copies
+    return size
+
+
+def bench_memory():
+    """ Compare the memory of slots and dictionary layouts. """
+    hass = setup_bench_home_assistant(0, BENCH_MEMORY_DEVICES)
+    try:
+        proximity = create_bench_proximity(hass, 0, BENCH_MEMORY_DEVICES)
+        proximity.check_proximity_initial_state()
+    finally:
+        hass.stop()
+
+    # the attribute values are shared so only the layouts are measured
+    records = list(proximity.device_cache.values())
+    trends = [record.trend for record in records]
+    print('memory: {} devices per entity'.format(BENCH_MEMORY_DEVICES))
+    for entities in BENCH_MEMORY_ENTITIES:
+        objects = ([proximity] * entities + records * entities +
+                   trends * entities)
+        dict_layout = layout_bytes(
+            lambda obj: DictLayout(slot_values(obj)), objects)
+        slots_layout = layout_bytes(slots_copy, objects)
+        print('  {} entities: dict layout {} kB, slots layout {} kB'.format(
+            entities, dict_layout // 1024, slots_layout // 1024))
+
+
+if __name__ == '__main__':
+    bench_zone_checks()
+    bench_memory()
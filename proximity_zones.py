@@ -3,6 +3,8 @@ custom_components.proximity_zones
 ~~~~~~~~~~~~~~~~~~~~~~~~~
 
 proximity_zones:
+  batch_window: 1
+  engine_workers: 2
   home:
     zone: home
     ignored_zones:
@@ -13,6 +15,14 @@ proximity_zones:
       - eleanorsiphone
       - tsiphone
     tolerance: 1
+    min_movement_m: 25
+    nearest_count: 3
+    enter_margin_m: 20
+    exit_margin_m: 50
+    min_delta_km: 1
+    min_interval_s: 30
+    publish_on_change: true
+    distance_mode: fast
     name: Home
   work:
     zone: work
@@ -25,11 +35,28 @@ proximity_zones:
 """
 
 import logging
-from homeassistant.helpers.event import track_state_change
+import math
+import multiprocessing
+import threading
+from datetime import timedelta
+from bisect import bisect_left, bisect_right, insort
+from array import array
+from collections import namedtuple
 from homeassistant.helpers.entity import Entity
-from homeassistant.util.location import distance
-from homeassistant.components import zone
-from homeassistant.const import CONF_NAME
+from homeassistant.const import (
+    CONF_NAME, EVENT_HOMEASSISTANT_STOP, EVENT_STATE_CHANGED)
+from homeassistant.helpers.event import track_point_in_utc_time
+import homeassistant.util.dt as dt_util
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 DEPENDENCIES = ['zone', 'device_tracker']
 
@@ -39,18 +66,121 @@ DOMAIN = 'proximity_zones'
 # default tolerance
 DEFAULT_TOLERANCE = 1
 
+# default minimum movement in meters before a device is re-evaluated
+DEFAULT_MIN_MOVEMENT = 0
+
+# default number of nearest devices to publish
+DEFAULT_NEAREST_COUNT = 3
+
+# default distances in meters a device must go past the edge of the zone
+# to enter or leave it
+DEFAULT_ENTER_MARGIN = 0
+DEFAULT_EXIT_MARGIN = 0
+
+# default publication policy, by default every change is published
+DEFAULT_MIN_DELTA = 0
+DEFAULT_MIN_INTERVAL = 0
+DEFAULT_PUBLISH_ON_CHANGE = True
+
 # default zone
 DEFAULT_PROXIMITY_ZONE = 'home'
 
+# default seconds to group device updates for, 0 updates immediately
+DEFAULT_BATCH_WINDOW = 0
+
+# default number of worker processes, 0 evaluates in Home Assistant
+DEFAULT_ENGINE_WORKERS = 0
+
+# configuration keys for the whole component rather than a proximity
+ENGINE_OPTIONS = ('batch_window', 'engine_workers')
+
+# messages to the worker processes
+SHARD_LOAD = 'load'
+SHARD_UPDATE = 'update'
+
+# seconds to wait for a worker process to stop before terminating it
+WORKER_STOP_TIMEOUT = 5
+
+# distance calculation modes
+DISTANCE_EXACT = 'exact'
+DISTANCE_FAST = 'fast'
+DEFAULT_DISTANCE_MODE = DISTANCE_EXACT
+
 # entity attributes
 ATTR_DIST_FROM = 'dist_to_zone'
 ATTR_DIR_OF_TRAVEL = 'dir_of_travel'
 ATTR_NEAREST = 'nearest'
 ATTR_FRIENDLY_NAME = 'friendly_name'
+ATTR_SUPPRESSED_UPDATES = 'suppressed_updates'
+ATTR_DROPPED_UPDATES = 'dropped_updates'
+ATTR_SPEED = 'speed_kmh'
+ATTR_SMOOTHED_DIR_OF_TRAVEL = 'smoothed_dir_of_travel'
+ATTR_ETA = 'eta_minutes'
+ATTR_NEAREST_DEVICES = 'nearest_devices'
+ATTR_REPORTING_INTERVALS = 'reporting_intervals'
+
+# number of recent distances used to estimate speed and direction
+TREND_WINDOW = 10
+
+# seconds between position reports that can be recommended to a device
+REPORTING_INTERVALS = (30, 60, 120, 300, 600, 900)
+
+# number of reports a device should make before it can reach the edge of
+# the zone
+REPORTING_BOUNDARY_REPORTS = 2
+
+# slowest speed in meters per second assumed when recommending a reporting
+# interval, a stationary device may start walking at any time
+REPORTING_MIN_SPEED = 1.4
+
+# device classifications
+DEVICE_NO_COORDINATES = 'no_coordinates'
+DEVICE_IN_ZONE = 'in_zone'
+DEVICE_IGNORED = 'ignored'
+DEVICE_ELIGIBLE = 'eligible'
+
+# relationships between zones
+ZONE_DISJOINT = 'disjoint'
+ZONE_OVERLAPS = 'overlaps'
+ZONE_CONTAINS = 'contains'
+ZONE_INSIDE = 'inside'
+
+# mean earth radius used by the distance calculations (in meters)
+EARTH_RADIUS = 6371008.8
+
+# minimum number of devices before the numpy batch engine is used
+BATCH_THRESHOLD = 8
+
+# longest distance in meters that the fast mode approximates
+FAST_DISTANCE_LIMIT = 100000
+
+# allowance in meters for floating point rounding in the fast mode
+FAST_DISTANCE_ERROR = 0.001
+
+# margin added to zone bounding boxes so rounding never rejects a device
+# inside the zone
+BOUNDING_BOX_MARGIN = 1.01
+
+# initial number of device slots in the position store
+POSITION_STORE_SIZE = 64
+
+# number of ignored zones before a spatial index is used to find them
+ZONE_INDEX_THRESHOLD = 10
+
+# size in degrees of the cells of the spatial index
+ZONE_INDEX_CELL_SIZE = 0.1
+
+# zones covering more cells are checked for every coordinate
+ZONE_INDEX_MAX_CELLS = 400
 
 # Shortcut for the logger
 _LOGGER = logging.getLogger(__name__)
 
+# position and size of a zone with the terms reused by distance calculations
+ZoneGeometry = namedtuple('ZoneGeometry', [
+    'entity_id', 'latitude', 'longitude', 'radius', 'lat_rad', 'lon_rad',
+    'cos_lat', 'sin_lat', 'min_lat', 'max_lat', 'min_lon', 'max_lon'])
+
 
 def setup(hass, config):  # pylint: disable=too-many-locals,too-many-statements
     """ get the zones and offsets from configuration.yaml"""
@@ -59,8 +189,24 @@ def setup(hass, config):  # pylint: disable=too-many-locals,too-many-statements
     if config.get(DOMAIN) is None:
         return False
 
+    batch_window = config[DOMAIN].get('batch_window', DEFAULT_BATCH_WINDOW)
+    engine_workers = config[DOMAIN].get('engine_workers',
+                                        DEFAULT_ENGINE_WORKERS)
+    if engine_workers and (np is None or shared_memory is None):
+        _LOGGER.error('engine workers need numpy and shared memory, '
+                      'evaluating proximities in Home Assistant')
+        engine_workers = 0
+
+    if engine_workers:
+        engine = ShardedProximityEngine(hass, batch_window, engine_workers)
+    else:
+        engine = ProximityEngine(hass, batch_window)
+
     for prox, prox_config in config[DOMAIN].items():
 
+        if prox in ENGINE_OPTIONS:
+            continue
+
         if not isinstance(prox_config, dict):
             _LOGGER.error("Missing configuration data for proximity %s", prox)
             continue
@@ -82,6 +228,30 @@ def setup(hass, config):  # pylint: disable=too-many-locals,too-many-statements
         # get the direction of travel tolerance from configuration.yaml
         tolerance = prox_config.get('tolerance', DEFAULT_TOLERANCE)
 
+        # get the minimum movement to re-evaluate from configuration.yaml
+        min_movement = prox_config.get('min_movement_m', DEFAULT_MIN_MOVEMENT)
+
+        # get the number of nearest devices to publish from configuration.yaml
+        nearest_count = prox_config.get('nearest_count', DEFAULT_NEAREST_COUNT)
+
+        # get the zone entry and exit margins from configuration.yaml
+        enter_margin = prox_config.get('enter_margin_m', DEFAULT_ENTER_MARGIN)
+        exit_margin = prox_config.get('exit_margin_m', DEFAULT_EXIT_MARGIN)
+
+        # get the publication policy from configuration.yaml
+        min_delta = prox_config.get('min_delta_km', DEFAULT_MIN_DELTA)
+        min_interval = prox_config.get('min_interval_s', DEFAULT_MIN_INTERVAL)
+        publish_on_change = prox_config.get('publish_on_change',
+                                            DEFAULT_PUBLISH_ON_CHANGE)
+
+        # get the distance calculation mode from configuration.yaml
+        distance_mode = prox_config.get('distance_mode',
+                                        DEFAULT_DISTANCE_MODE)
+        if distance_mode not in (DISTANCE_EXACT, DISTANCE_FAST):
+            _LOGGER.error('unknown distance mode %s for proximity %s',
+                          distance_mode, prox)
+            distance_mode = DEFAULT_DISTANCE_MODE
+
         # get the zone to monitor proximity to from configuration.yaml
         proximity_zone = 'zone.' + prox_config.get('zone',
                                                    DEFAULT_PROXIMITY_ZONE)
@@ -101,41 +271,655 @@ def setup(hass, config):  # pylint: disable=too-many-locals,too-many-statements
         proximity = Proximity(hass, zone_friendly_name, dist_to_zone,
                               dir_of_travel, nearest, ignored_zones,
                               proximity_devices, tolerance, proximity_zone,
-                              friendly_name)
+                              friendly_name, min_movement, nearest_count,
+                              distance_mode, engine.positions, enter_margin,
+                              exit_margin, min_delta, min_interval,
+                              publish_on_change)
         proximity.entity_id = entity_id
 
-        proximity.update_ha_state()
-        proximity.check_proximity_initial_state()
-
         proximities.append(proximity)
-        # main command to monitor proximity of devices
-        track_state_change(hass, proximity.proximity_devices,
-                           proximity.check_proximity_state_change)
+        engine.add_proximity(proximity)
 
     if not proximities:
         _LOGGER.error("No proximities added")
         return False
 
+    # locate every device for every proximity at once and write each
+    # entity a single time
+    engine.check_initial_state()
+    engine.start()
+
+    # main command to monitor proximity of devices and changes to zones
+    hass.bus.listen(EVENT_STATE_CHANGED, engine.state_changed_listener)
+
     # Tells the bootstrapper that the component was successfully initialized
     return True
 
 
+def build_zone_geometry(entity_id, latitude, longitude, radius=0):
+    """ Create the geometry of a zone from its position and radius """
+    lat_rad = math.radians(latitude)
+    cos_lat = math.cos(lat_rad)
+
+    # bounding box of the zone in degrees
+    lat_delta = math.degrees(radius * BOUNDING_BOX_MARGIN / EARTH_RADIUS)
+    min_lat = latitude - lat_delta
+    max_lat = latitude + lat_delta
+    if min_lat <= -90 or max_lat >= 90 or cos_lat <= 0:
+        # the box includes a pole so every longitude is in range
+        min_lon = -180
+        max_lon = 180
+    else:
+        lon_delta = lat_delta / min(math.cos(math.radians(min_lat)),
+                                    math.cos(math.radians(max_lat)))
+        min_lon = longitude - lon_delta
+        max_lon = longitude + lon_delta
+        if min_lon < -180 or max_lon > 180:
+            # the box crosses the antimeridian
+            min_lon = -180
+            max_lon = 180
+
+    return ZoneGeometry(entity_id, latitude, longitude, radius, lat_rad,
+                        math.radians(longitude), cos_lat, math.sin(lat_rad),
+                        min_lat, max_lat, min_lon, max_lon)
+
+
+def in_bounding_box(geometry, latitude, longitude):
+    """ Test if a coordinate is in the bounding box of a zone """
+    return (geometry.min_lat <= latitude <= geometry.max_lat and
+            geometry.min_lon <= longitude <= geometry.max_lon)
+
+
+def zone_state_geometry(zone_state):
+    """ Create the geometry of a zone from its state """
+    return build_zone_geometry(zone_state.entity_id,
+                               zone_state.attributes.get('latitude'),
+                               zone_state.attributes.get('longitude'),
+                               zone_state.attributes.get('radius', 0))
+
+
+def zone_haversine(geometry, latitude, longitude):
+    """ Calculate the distance in meters from a zone to a point """
+    lat_rad = math.radians(latitude)
+    hav = (math.sin((lat_rad - geometry.lat_rad) / 2) ** 2 +
+           geometry.cos_lat * math.cos(lat_rad) *
+           math.sin((math.radians(longitude) - geometry.lon_rad) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(hav, 1.0)))
+
+
+def zone_equirectangular(geometry, latitude, longitude):
+    """ Approximate the distance in meters from a zone to a nearby point
+
+    Returns the distance and the most it can differ from the haversine
+    distance, or None if the point is too far away or the zone is too close
+    to a pole to approximate.
+    """
+    if geometry.cos_lat < 0.1:
+        return None
+
+    lat_delta = math.radians(latitude) - geometry.lat_rad
+    lon_delta = math.radians(longitude) - geometry.lon_rad
+    if lon_delta > math.pi:
+        lon_delta -= 2 * math.pi
+    elif lon_delta < -math.pi:
+        lon_delta += 2 * math.pi
+
+    # cosine of the mean latitude from the precomputed zone terms
+    cos_mean = (geometry.cos_lat * (1 - lat_delta * lat_delta / 8) -
+                geometry.sin_lat * lat_delta / 2)
+    approximation = EARTH_RADIUS * math.hypot(lat_delta, lon_delta * cos_mean)
+    if approximation > FAST_DISTANCE_LIMIT:
+        return None
+
+    # the error grows with the cube of the distance and towards the poles
+    error = (approximation ** 3 /
+             (EARTH_RADIUS * geometry.cos_lat) ** 2 + FAST_DISTANCE_ERROR)
+    return approximation, error
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """ Calculate the distance in meters between two points """
+    return zone_haversine(build_zone_geometry(None, latitude1, longitude1),
+                          latitude2, longitude2)
+
+
+def zone_relation(first, second):
+    """ Work out how the first zone relates to the second zone """
+    centre_distance = zone_haversine(first, second.latitude,
+                                     second.longitude)
+    if centre_distance >= first.radius + second.radius:
+        return ZONE_DISJOINT
+    if centre_distance + second.radius <= first.radius:
+        return ZONE_CONTAINS
+    if centre_distance + first.radius <= second.radius:
+        return ZONE_INSIDE
+    return ZONE_OVERLAPS
+
+
+def build_zone_relations(zone_table):
+    """ Work out how every pair of zones relate to each other
+
+    Returns a dictionary of relationships keyed by (first, second) zone
+    entity ids.
+    """
+    opposite = {ZONE_CONTAINS: ZONE_INSIDE, ZONE_INSIDE: ZONE_CONTAINS}
+    relations = {}
+    for index, first in enumerate(zone_table):
+        for second in zone_table[index + 1:]:
+            if first.entity_id == second.entity_id:
+                continue
+            relation = zone_relation(first, second)
+            relations[(first.entity_id, second.entity_id)] = relation
+            relations[(second.entity_id, first.entity_id)] = opposite.get(
+                relation, relation)
+    return relations
+
+
+def zone_distances(geometry, latitudes, longitudes):
+    """ Calculate the distances in meters from a zone to many points """
+    if np is None or len(latitudes) < BATCH_THRESHOLD:
+        return [zone_haversine(geometry, lat, lon)
+                for lat, lon in zip(latitudes, longitudes)]
+
+    # haversine over all the points in a single array operation
+    lats = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lons = np.radians(np.asarray(longitudes, dtype=np.float64))
+    hav = (np.sin((lats - geometry.lat_rad) / 2) ** 2 +
+           geometry.cos_lat * np.cos(lats) *
+           np.sin((lons - geometry.lon_rad) / 2) ** 2)
+    return (2 * EARTH_RADIUS *
+            np.arcsin(np.sqrt(np.minimum(hav, 1.0)))).tolist()
+
+
+def distance_matrix(zone_table, latitudes, longitudes):
+    """ Calculate the distances in meters from many points to many zones
+
+    Returns a row of the distances to the zones for each point.
+    """
+    if np is None or len(latitudes) * len(zone_table) < BATCH_THRESHOLD:
+        columns = [zone_distances(geometry, latitudes, longitudes)
+                   for geometry in zone_table]
+        return [list(row) for row in zip(*columns)]
+
+    # haversine over every point and zone in a single array operation
+    lats = np.radians(np.asarray(latitudes, dtype=np.float64))[:, np.newaxis]
+    lons = np.radians(np.asarray(longitudes, dtype=np.float64))[:, np.newaxis]
+    zone_lats = np.array([geometry.lat_rad for geometry in zone_table])
+    zone_lons = np.array([geometry.lon_rad for geometry in zone_table])
+    zone_cos = np.array([geometry.cos_lat for geometry in zone_table])
+    hav = (np.sin((lats - zone_lats) / 2) ** 2 +
+           zone_cos * np.cos(lats) * np.sin((lons - zone_lons) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(hav, 1.0)))
+
+
+def batch_distance(latitude, longitude, latitudes, longitudes):
+    """ Calculate the distances in meters from one point to many points """
+    return zone_distances(build_zone_geometry(None, latitude, longitude),
+                          latitudes, longitudes)
+
+
+def state_timestamp(state):
+    """ Time in seconds that a state was last updated """
+    last_updated = getattr(state, 'last_updated', None) or dt_util.utcnow()
+    return last_updated.timestamp()
+
+
+def float_column(size):
+    """ Create a column of floats that are all NaN """
+    if np is None:
+        return array('d', [float('nan')]) * size
+    return np.full(size, np.nan)
+
+
+def grow_column(column, size):
+    """ Extend a column of floats with NaN up to size """
+    if np is None:
+        return column + float_column(size - len(column))
+    return np.concatenate((column, float_column(size - len(column))))
+
+
+class PositionStore(object):
+    """ Last known position of every device in contiguous columns
+
+    Each device has a slot in the latitude, longitude and timestamp
+    columns, a device without coordinates has NaN coordinates.
+    """
+    def __init__(self, size=POSITION_STORE_SIZE):
+        self.slots = {}
+        self.names = []
+        self.latitudes = float_column(size)
+        self.longitudes = float_column(size)
+        self.timestamps = float_column(size)
+
+    def slot(self, entity):
+        """ Slot of a device, new devices are given the next free slot """
+        slot = self.slots.get(entity)
+        if slot is not None:
+            return slot
+
+        slot = len(self.names)
+        if slot == len(self.latitudes):
+            size = 2 * slot
+            self.latitudes = grow_column(self.latitudes, size)
+            self.longitudes = grow_column(self.longitudes, size)
+            self.timestamps = grow_column(self.timestamps, size)
+        self.slots[entity] = slot
+        self.names.append(None)
+        return slot
+
+    def update(self, entity, state):
+        """ Store the position of a device from its state, returns the slot
+        of the device """
+        slot = self.slot(entity)
+        if state is None or 'latitude' not in state.attributes:
+            latitude = longitude = float('nan')
+        else:
+            latitude = state.attributes['latitude']
+            longitude = state.attributes['longitude']
+
+        self.names[slot] = state.name if state else None
+        self.latitudes[slot] = latitude
+        self.longitudes[slot] = longitude
+        self.timestamps[slot] = state_timestamp(state)
+        return slot
+
+    def position(self, slot):
+        """ Coordinates of a slot, or None if the device has no coordinates """
+        latitude = float(self.latitudes[slot])
+        if math.isnan(latitude):
+            return None
+        return latitude, float(self.longitudes[slot])
+
+    def positions(self, slots):
+        """ Latitudes and longitudes of many slots """
+        if np is None:
+            return ([self.latitudes[slot] for slot in slots],
+                    [self.longitudes[slot] for slot in slots])
+        index = np.asarray(slots, dtype=np.intp)
+        return self.latitudes[index], self.longitudes[index]
+
+
+class SharedPositionStore(PositionStore):
+    """ Position store with its columns in shared memory
+
+    Worker processes attach to the columns by their block names and read
+    the positions without copying them. The columns cannot grow, so every
+    device needs a slot before the store is created.
+    """
+    def __init__(self, size, block_names=None):
+        # pylint: disable=super-init-not-called
+        self.slots = {}
+        self.names = []
+        self.blocks = []
+        columns = []
+        for block_name in block_names or (None, None, None):
+            if block_name is None:
+                block = shared_memory.SharedMemory(create=True,
+                                                   size=max(size, 1) * 8)
+            else:
+                block = shared_memory.SharedMemory(name=block_name)
+            self.blocks.append(block)
+            columns.append(np.ndarray(size, dtype=np.float64,
+                                      buffer=block.buf))
+        self.latitudes, self.longitudes, self.timestamps = columns
+        if block_names is None:
+            for column in columns:
+                column.fill(np.nan)
+
+    @classmethod
+    def from_store(cls, store):
+        """ Create a shared store with the slots and positions of a store """
+        shared = cls(len(store.names))
+        shared.slots = dict(store.slots)
+        shared.names = list(store.names)
+        for column, source in ((shared.latitudes, store.latitudes),
+                               (shared.longitudes, store.longitudes),
+                               (shared.timestamps, store.timestamps)):
+            column[:] = source[:len(column)]
+        return shared
+
+    @property
+    def block_names(self):
+        """ Names of the shared memory blocks of the columns """
+        return [block.name for block in self.blocks]
+
+    def slot(self, entity):
+        """ Slot of a device, the store cannot hold new devices """
+        if entity not in self.slots and len(self.names) == len(self.latitudes):
+            raise ValueError('no slot for {} in the shared position '
+                             'store'.format(entity))
+        return super().slot(entity)
+
+    def close(self, unlink=False):
+        """ Detach from the shared memory, unlink it to free it """
+        self.latitudes = self.longitudes = self.timestamps = None
+        for block in self.blocks:
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = []
+
+
+def shard_worker(connection, block_names, size):
+    """ Evaluate a shard of the proximities in a worker process
+
+    Proximities are loaded with a SHARD_LOAD message and kept up to date
+    with SHARD_UPDATE messages of (entity, slot, name) tuples. Each update
+    message is answered with the evaluation results of the proximities that
+    changed, None stops the worker.
+    """
+    positions = SharedPositionStore(size, block_names)
+    positions.names = [None] * size
+    proximities = {}
+    device_index = {}
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                return
+            command, payload = message
+
+            if command == SHARD_LOAD:
+                for proximity in payload:
+                    proximity.positions = positions
+                    proximities[proximity.entity_id] = proximity
+                device_index = {}
+                for proximity in proximities.values():
+                    for device in proximity.device_order:
+                        device_index.setdefault(device, []).append(proximity)
+
+            elif command == SHARD_UPDATE:
+                changed = {}
+                for entity, slot, name in payload:
+                    positions.names[slot] = name
+                    for proximity in device_index.get(entity, ()):
+                        if proximity.position_has_moved(
+                                entity, positions.position(slot)):
+                            proximity.relocate_device(entity, slot)
+                            changed.setdefault(
+                                proximity.entity_id,
+                                (proximity, []))[1].append(entity)
+
+                connection.send([
+                    (proximity.entity_id,
+                     proximity.evaluate_proximity(entities), entities)
+                    for proximity, entities in changed.values()])
+    finally:
+        positions.close()
+
+
+class DistanceTrend(object):
+    """ Sliding window of the distances of a device to a zone
+
+    A running least squares fit gives the rate of change of the distance,
+    each new distance takes constant time and memory.
+    """
+    __slots__ = ('size', 'times', 'distances', 'count', 'index', 'origin',
+                 'sum_t', 'sum_d', 'sum_tt', 'sum_td')
+
+    def __init__(self, size=TREND_WINDOW):
+        self.size = size
+        self.times = array('d', [0.0] * size)
+        self.distances = array('d', [0.0] * size)
+        self.count = 0
+        self.index = 0
+        self.origin = None
+        self.sum_t = 0.0
+        self.sum_d = 0.0
+        self.sum_tt = 0.0
+        self.sum_td = 0.0
+
+    def add(self, timestamp, dist):
+        """ Add a distance in meters measured at a time in seconds """
+        if self.origin is None:
+            self.origin = timestamp
+        time = timestamp - self.origin
+
+        # replace the oldest distance once the window is full
+        if self.count == self.size:
+            old_time = self.times[self.index]
+            old_dist = self.distances[self.index]
+            self.sum_t -= old_time
+            self.sum_d -= old_dist
+            self.sum_tt -= old_time * old_time
+            self.sum_td -= old_time * old_dist
+        else:
+            self.count += 1
+
+        self.times[self.index] = time
+        self.distances[self.index] = dist
+        self.sum_t += time
+        self.sum_d += dist
+        self.sum_tt += time * time
+        self.sum_td += time * dist
+
+        self.index = (self.index + 1) % self.size
+        if self.index == 0:
+            self.rebase()
+
+    def rebase(self):
+        """ Move the origin to the oldest time and recalculate the sums so
+        rounding errors cannot build up """
+        oldest = self.times[0]
+        self.origin += oldest
+        self.sum_t = self.sum_d = self.sum_tt = self.sum_td = 0.0
+        for index in range(self.count):
+            time = self.times[index] - oldest
+            self.times[index] = time
+            self.sum_t += time
+            self.sum_d += self.distances[index]
+            self.sum_tt += time * time
+            self.sum_td += time * self.distances[index]
+
+    @property
+    def span(self):
+        """ Seconds between the oldest and newest distances """
+        if self.count < 2:
+            return 0
+        newest = self.times[self.index - 1]
+        oldest = self.times[self.index if self.count == self.size else 0]
+        return newest - oldest
+
+    @property
+    def slope(self):
+        """ Rate of change of the distance in meters per second, or None if
+        it cannot be estimated """
+        denominator = self.count * self.sum_tt - self.sum_t * self.sum_t
+        if self.count < 2 or denominator <= 0:
+            return None
+        return ((self.count * self.sum_td - self.sum_t * self.sum_d) /
+                denominator)
+
+
+class ZoneIndex(object):
+    """ Grid of zones to find the zones that may contain a coordinate """
+    def __init__(self, cell_size=ZONE_INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.zones = {}
+        self.cells = {}
+        self.wide_zones = set()
+
+    def cell(self, latitude, longitude):
+        """ Grid cell that a coordinate is in """
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def zone_cells(self, geometry):
+        """ Grid cells covered by the bounding box of a zone, or None if
+        there are too many """
+        min_row, min_col = self.cell(geometry.min_lat, geometry.min_lon)
+        max_row, max_col = self.cell(geometry.max_lat, geometry.max_lon)
+        if ((max_row - min_row + 1) * (max_col - min_col + 1) >
+                ZONE_INDEX_MAX_CELLS):
+            return None
+        return [(row, col) for row in range(min_row, max_row + 1)
+                for col in range(min_col, max_col + 1)]
+
+    def add_zone(self, geometry):
+        """ Add a zone to the index """
+        self.zones[geometry.entity_id] = geometry
+        cells = self.zone_cells(geometry)
+        if cells is None:
+            self.wide_zones.add(geometry.entity_id)
+            return
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(geometry.entity_id)
+
+    def remove_zone(self, entity_id):
+        """ Remove a zone from the index """
+        geometry = self.zones.pop(entity_id, None)
+        if geometry is None:
+            return
+        self.wide_zones.discard(entity_id)
+        for cell in self.zone_cells(geometry) or ():
+            cell_zones = self.cells[cell]
+            cell_zones.discard(entity_id)
+            if not cell_zones:
+                del self.cells[cell]
+
+    def update_zones(self, zone_table):
+        """ Update the index to match the zones, only the zones that have
+        changed are re-indexed """
+        zone_ids = set(geometry.entity_id for geometry in zone_table)
+        for entity_id in list(self.zones):
+            if entity_id not in zone_ids:
+                self.remove_zone(entity_id)
+        for geometry in zone_table:
+            if self.zones.get(geometry.entity_id) != geometry:
+                self.remove_zone(geometry.entity_id)
+                self.add_zone(geometry)
+
+    def candidates(self, latitude, longitude):
+        """ Zones that may contain a coordinate, largest first """
+        zone_ids = self.cells.get(self.cell(latitude, longitude), set())
+        if self.wide_zones:
+            zone_ids = zone_ids | self.wide_zones
+        return sorted((self.zones[entity_id] for entity_id in zone_ids),
+                      key=lambda geometry: geometry.radius, reverse=True)
+
+
+class DeviceRecord(object):
+    """ Last known location of a device and its distance to a zone """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('name', 'latitude', 'longitude', 'status', 'distance',
+                 'error', 'last_distance', 'last_error', 'last_latitude',
+                 'last_longitude', 'trend', 'reporting_interval')
+
+    def __init__(self, name=None):
+        self.name = name
+        self.latitude = None
+        self.longitude = None
+        self.status = DEVICE_NO_COORDINATES
+        self.distance = None
+        self.error = 0
+        self.last_distance = None
+        self.last_error = 0
+        self.last_latitude = None
+        self.last_longitude = None
+        self.trend = None
+        self.reporting_interval = None
+
+
 class Proximity(Entity):  # pylint: disable=too-many-instance-attributes
     """ Represents a Proximity in Home Assistant. """
+    __slots__ = ('hass', 'entity_id', 'friendly_name', 'zone_friendly_name',
+                 'dist_to', 'dir_of_travel', 'nearest', 'speed',
+                 'smoothed_dir_of_travel', 'eta', 'nearest_devices',
+                 'reporting_intervals', 'ignored_zones', 'proximity_devices',
+                 'tolerance', 'proximity_zone', 'min_movement',
+                 'nearest_count', 'distance_mode', 'enter_margin',
+                 'exit_margin', 'min_delta', 'min_interval',
+                 'publish_on_change', 'last_published', 'pending_result',
+                 'publish_scheduled', 'publish_lock', 'positions',
+                 'device_cache', 'device_order', 'nearest_order',
+                 'devices_in_zone', 'zone_geometry', 'ignored_zone_geometry',
+                 'zone_relations', 'zones_inside', 'zone_index', 'zone_checks',
+                 'suppressed_updates', 'dropped_updates')
+
     def __init__(self, hass, zone_friendly_name, dist_to, dir_of_travel,
                  nearest, ignored_zones, proximity_devices, tolerance,
-                 proximity_zone, friendly_name):
+                 proximity_zone, friendly_name, min_movement=0,
+                 nearest_count=DEFAULT_NEAREST_COUNT,
+                 distance_mode=DEFAULT_DISTANCE_MODE, positions=None,
+                 enter_margin=DEFAULT_ENTER_MARGIN,
+                 exit_margin=DEFAULT_EXIT_MARGIN, min_delta=DEFAULT_MIN_DELTA,
+                 min_interval=DEFAULT_MIN_INTERVAL,
+                 publish_on_change=DEFAULT_PUBLISH_ON_CHANGE):
         # pylint: disable=too-many-arguments
         self.hass = hass
+        self.entity_id = None
         self.friendly_name = friendly_name
         self.zone_friendly_name = zone_friendly_name
         self.dist_to = dist_to
         self.dir_of_travel = dir_of_travel
         self.nearest = nearest
+        self.speed = 'not set'
+        self.smoothed_dir_of_travel = 'not set'
+        self.eta = 'not set'
+        self.nearest_devices = 'not set'
+        self.reporting_intervals = 'not set'
         self.ignored_zones = ignored_zones
         self.proximity_devices = proximity_devices
         self.tolerance = tolerance
         self.proximity_zone = proximity_zone
+        self.min_movement = min_movement
+        self.nearest_count = nearest_count
+        self.distance_mode = distance_mode
+        self.enter_margin = enter_margin
+        self.exit_margin = exit_margin
+        # changes smaller than min_delta km are not published and changes
+        # sooner than min_interval seconds after the last write are delayed,
+        # unless the direction or nearest device changes and
+        # publish_on_change is set
+        self.min_delta = min_delta
+        self.min_interval = min_interval
+        self.publish_on_change = publish_on_change
+        self.last_published = None
+        # latest result held back by the minimum interval, written by a
+        # timer once the interval has passed
+        self.pending_result = None
+        self.publish_scheduled = False
+        # the timer writes from another thread than the device updates
+        self.publish_lock = threading.RLock()
+        # positions of the devices, shared with the other proximities when
+        # the proximity is part of an engine
+        self.positions = positions if positions is not None else \
+            PositionStore()
+        # last known coordinates and distance to the zone of each device
+        self.device_cache = {}
+        # eligible devices sorted by distance and the devices in the zone,
+        # ties are broken by the order of the devices in the configuration
+        self.device_order = {}
+        for index, device in enumerate(proximity_devices):
+            self.device_order.setdefault(device, index)
+        self.nearest_order = []
+        self.devices_in_zone = set()
+        # geometry of the monitored and ignored zones
+        self.zone_geometry = None
+        self.ignored_zone_geometry = ()
+        self.zone_relations = {}
+        self.zones_inside = {}
+        self.zone_index = None
+        self.update_zone_geometry()
+        # number of exact device to zone distances calculated
+        self.zone_checks = 0
+        # number of evaluations that did not change the entity
+        self.suppressed_updates = 0
+        # number of device updates replaced before they were applied
+        self.dropped_updates = 0
+
+    def __getstate__(self):
+        """ Attributes copied to a worker process, Home Assistant and the
+        position store stay behind """
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name not in ('hass', 'positions', 'publish_lock'))
+
+    def __setstate__(self, state):
+        self.hass = None
+        self.positions = None
+        self.publish_lock = threading.RLock()
+        for name, value in state.items():
+            setattr(self, name, value)
 
     @property
     def state(self):
@@ -151,263 +935,979 @@ class Proximity(Entity):  # pylint: disable=too-many-instance-attributes
         return {
             ATTR_DIR_OF_TRAVEL: self.dir_of_travel,
             ATTR_NEAREST: self.nearest,
-            ATTR_FRIENDLY_NAME: self.friendly_name
+            ATTR_FRIENDLY_NAME: self.friendly_name,
+            ATTR_SUPPRESSED_UPDATES: self.suppressed_updates,
+            ATTR_DROPPED_UPDATES: self.dropped_updates,
+            ATTR_SPEED: self.speed,
+            ATTR_SMOOTHED_DIR_OF_TRAVEL: self.smoothed_dir_of_travel,
+            ATTR_ETA: self.eta,
+            ATTR_NEAREST_DEVICES: self.nearest_devices,
+            ATTR_REPORTING_INTERVALS: self.reporting_intervals
         }
 
-    def check_proximity_state_change(self, entity, old_state, new_state):
-        # pylint: disable=too-many-branches,too-many-statements,too-many-locals
-        """ Function to perform the proximity checking """
-        entity_name = new_state.name
-        devices_to_calculate = self.ignored_zones == []
-        devices_have_coordinates = False
-        devices_in_zone = ''
-
-        zone_state = self.hass.states.get(self.proximity_zone)
-        proximity_latitude = zone_state.attributes.get('latitude')
-        proximity_longitude = zone_state.attributes.get('longitude')
-
-        # check for devices in the monitored zone
-        for device in self.proximity_devices:
-            device_state = self.hass.states.get(device)
+    @property
+    def zone_entities(self):
+        """ Entity ids of the monitored and ignored zones """
+        return [self.proximity_zone] + ['zone.' + ignored_zone
+                                        for ignored_zone in self.ignored_zones]
 
-            if 'latitude' not in device_state.attributes:
+    @property
+    def zone_table(self):
+        """ Geometry of the monitored zone followed by the ignored zones """
+        return (self.zone_geometry,) + self.ignored_zone_geometry
+
+    def update_zone_geometry(self):
+        """ Read the geometry of the monitored and ignored zones """
+        self.zone_geometry = zone_state_geometry(
+            self.hass.states.get(self.proximity_zone))
+
+        ignored_zone_geometry = []
+        for ignored_zone in self.ignored_zones:
+            ignored_zone_state = self.hass.states.get('zone.' + ignored_zone)
+            if ignored_zone_state is None:
+                _LOGGER.error('ignored zone %s not found', ignored_zone)
                 continue
+            ignored_zone_geometry.append(
+                zone_state_geometry(ignored_zone_state))
+
+        # check the largest zones first so the zones inside them can be
+        # skipped
+        ignored_zone_geometry.sort(key=lambda geometry: geometry.radius,
+                                   reverse=True)
+        self.ignored_zone_geometry = tuple(ignored_zone_geometry)
+
+        # index the ignored zones when there are too many to check each one
+        if len(ignored_zone_geometry) >= ZONE_INDEX_THRESHOLD:
+            if self.zone_index is None:
+                self.zone_index = ZoneIndex()
+            self.zone_index.update_zones(ignored_zone_geometry)
+        else:
+            self.zone_index = None
+
+        # a device outside a zone cannot be in any of the zones inside it
+        self.zone_relations = build_zone_relations(self.zone_table)
+        zones_inside = {}
+        for geometry in self.zone_table:
+            zones_inside[geometry.entity_id] = frozenset(
+                ignored.entity_id for ignored in self.ignored_zone_geometry
+                if self.zone_relations.get((geometry.entity_id,
+                                            ignored.entity_id)) ==
+                ZONE_CONTAINS)
+        self.zones_inside = zones_inside
+
+    def check_zone_state_change(self, entity, old_state, new_state):
+        """ Function to recalculate the proximity when a zone changes """
+        # pylint: disable=unused-argument
+        if entity == self.proximity_zone and new_state is None:
+            _LOGGER.error('proximity zone %s removed', entity)
+            return
 
-            devices_have_coordinates = True
-
-            device_state_lat = device_state.attributes['latitude']
-            device_state_lon = device_state.attributes['longitude']
-
-            for ignored_zone in self.ignored_zones:
-                ignored_zone_state = self.hass.states.get('zone.' +
-                                                          ignored_zone)
-                if not zone.in_zone(ignored_zone_state,
-                                    device_state_lat,
-                                    device_state_lon):
-                    devices_to_calculate = True
-
-            # check the location of all devices
-            if zone.in_zone(zone_state,
-                            device_state_lat,
-                            device_state_lon):
-                device_friendly = device_state.name
-                if devices_in_zone != '':
-                    devices_in_zone = devices_in_zone + ', '
-                devices_in_zone = devices_in_zone + device_friendly
-
-        # at least one device is in the monitored zone so update the entity
-        if devices_in_zone != '':
-            self.dist_to = 0
-            self.dir_of_travel = 'arrived'
-            self.nearest = devices_in_zone
-            self.update_ha_state()
+        self.update_zone_geometry()
+        self.check_proximity_initial_state()
+
+    def zone_distance(self, geometry, record, zone_distances):
+        """ Distance in meters from a located device to a zone
+
+        Distances are shared through zone_distances so each zone is only
+        calculated once per device update.
+        """
+        if geometry.entity_id not in zone_distances:
+            self.zone_checks += 1
+            zone_distances[geometry.entity_id] = zone_haversine(
+                geometry, record.latitude, record.longitude)
+        return zone_distances[geometry.entity_id]
+
+    def measure(self, geometry, record, zone_distances):
+        """ Distance in meters from a located device to a zone and the most
+        it can be out by
+
+        The fast mode approximates distances that have not already been
+        calculated, approximations are never shared through zone_distances.
+        """
+        if (self.distance_mode == DISTANCE_FAST and
+                geometry.entity_id not in zone_distances):
+            approximation = zone_equirectangular(
+                geometry, record.latitude, record.longitude)
+            if approximation is not None:
+                return approximation
+        return self.zone_distance(geometry, record, zone_distances), 0
+
+    def in_zone(self, geometry, record, zone_distances, radius=None):
+        """ Test if a located device is in a zone
+
+        radius replaces the radius of the zone if given. The bounding box
+        of the zone rejects devices that are clearly outside it before the
+        distance is calculated.
+        """
+        if radius is None:
+            radius = geometry.radius
+        if (geometry.entity_id not in zone_distances and
+                radius <= geometry.radius and
+                not in_bounding_box(geometry, record.latitude,
+                                    record.longitude)):
+            return False
+
+        dist, error = self.measure(geometry, record, zone_distances)
+        # an approximation too close to the edge of the zone is not trusted
+        if abs(dist - radius) <= error:
+            dist = self.zone_distance(geometry, record, zone_distances)
+        return dist < radius
+
+    def zone_radius(self, was_in_zone):
+        """ Radius of the monitored zone for a device, devices have to go
+        past the margins to enter or leave the zone """
+        if was_in_zone:
+            return self.zone_geometry.radius + self.exit_margin
+        return max(self.zone_geometry.radius - self.enter_margin, 0)
+
+    def measure_device(self, record, zone_distances):
+        """ Set the distance from a located device to the monitored zone """
+        dist, error = self.measure(self.zone_geometry, record, zone_distances)
+        # the distance is published rounded to 100 meters, an approximation
+        # too close to the rounding boundary is not trusted
+        if error and abs(dist % 100 - 50) <= error:
+            dist = self.zone_distance(self.zone_geometry, record,
+                                      zone_distances)
+            error = 0
+        record.distance = dist
+        record.error = error
+
+    def locate_device(self, slot, zone_distances=None, was_in_zone=False):
+        """ Classify a device from its slot in the position store
+
+        zone_distances are the distances from the device to any zones that
+        have already been calculated, was_in_zone is True if the device was
+        last located in the monitored zone.
+        """
+        record = DeviceRecord(self.positions.names[slot])
+
+        # proximity cannot be calculated without coordinates
+        position = self.positions.position(slot)
+        if position is None:
+            return record
+
+        record.latitude, record.longitude = position
+
+        if zone_distances is None:
+            zone_distances = {}
+
+        # the monitored zone wins when zones overlap
+        if self.in_zone(self.zone_geometry, record, zone_distances,
+                        self.zone_radius(was_in_zone)):
+            record.status = DEVICE_IN_ZONE
+            self.measure_device(record, zone_distances)
+            return record
+
+        if self.zone_index is None:
+            ignored_zone_geometry = self.ignored_zone_geometry
+        else:
+            ignored_zone_geometry = self.zone_index.candidates(
+                record.latitude, record.longitude)
+
+        # the zones inside the monitored zone can only be skipped when the
+        # device is outside its real radius, not just short of the margin
+        excluded_zones = set()
+        if (self.zone_radius(was_in_zone) >= self.zone_geometry.radius or
+                not self.in_zone(self.zone_geometry, record, zone_distances)):
+            excluded_zones.update(self.zones_inside[self.proximity_zone])
+        for geometry in ignored_zone_geometry:
+            if geometry.entity_id in excluded_zones:
+                continue
+            if self.in_zone(geometry, record, zone_distances):
+                # the distance is kept for the direction of travel once the
+                # device leaves the ignored zone
+                record.status = DEVICE_IGNORED
+                self.measure_device(record, zone_distances)
+                return record
+            excluded_zones.update(self.zones_inside[geometry.entity_id])
+
+        record.status = DEVICE_ELIGIBLE
+        self.measure_device(record, zone_distances)
+        return record
+
+    def update_device_cache(self, entity, device_state, zone_distances=None):
+        """ Recalculate the cached location of a single device """
+        self.relocate_device(entity, self.positions.update(entity,
+                                                           device_state),
+                             zone_distances)
+
+    def relocate_device(self, entity, slot, zone_distances=None):
+        """ Recalculate the cached location of a device from the position
+        store """
+        previous = self.device_cache.get(entity)
+        record = self.locate_device(
+            slot, zone_distances,
+            previous is not None and previous.status == DEVICE_IN_ZONE)
+
+        # keep the last known distance for the direction of travel
+        if previous is not None:
+            if previous.distance is not None:
+                record.last_distance = previous.distance
+                record.last_error = previous.error
+                record.last_latitude = previous.latitude
+                record.last_longitude = previous.longitude
+            else:
+                record.last_distance = previous.last_distance
+                record.last_error = previous.last_error
+                record.last_latitude = previous.last_latitude
+                record.last_longitude = previous.last_longitude
+            record.trend = previous.trend
+            self.unindex_device(entity, previous)
+
+        self.add_to_trend(record, self.positions.timestamps[slot])
+        record.reporting_interval = self.reporting_interval(record)
+        self.device_cache[entity] = record
+        self.index_device(entity, record)
+
+    def nearest_key(self, entity, record):
+        """ Sort key of an eligible device in the nearest order """
+        return (round(record.distance / 1000, 1),
+                self.device_order[entity], entity)
+
+    def index_device(self, entity, record):
+        """ Add a located device to the nearest order """
+        if record.status == DEVICE_IN_ZONE:
+            self.devices_in_zone.add(entity)
+        elif record.status == DEVICE_ELIGIBLE:
+            insort(self.nearest_order, self.nearest_key(entity, record))
+
+    def unindex_device(self, entity, record):
+        """ Remove a located device from the nearest order """
+        if record.status == DEVICE_IN_ZONE:
+            self.devices_in_zone.discard(entity)
+        elif record.status == DEVICE_ELIGIBLE:
+            key = self.nearest_key(entity, record)
+            index = bisect_left(self.nearest_order, key)
+            if (index < len(self.nearest_order) and
+                    self.nearest_order[index] == key):
+                del self.nearest_order[index]
+
+    @staticmethod
+    def add_to_trend(record, timestamp):
+        """ Add the distance of a located device to its trend """
+        if record.distance is None:
             return
+        if record.trend is None:
+            record.trend = DistanceTrend()
+        record.trend.add(float(timestamp), record.distance)
+
+    def reporting_interval(self, record):
+        """ Recommended seconds between the position reports of a located
+        device, or None if the device has no distance to the zone or is in
+        an ignored zone
+
+        Devices close to the edge of the zone, or moving quickly towards or
+        away from it, should report often.
+        """
+        if record.distance is None or record.status == DEVICE_IGNORED:
+            return None
+
+        speed = REPORTING_MIN_SPEED
+        if record.trend is not None and record.trend.slope is not None:
+            speed = max(abs(record.trend.slope), speed)
+
+        # time until the device could reach the edge of the zone
+        interval = (abs(record.distance - self.zone_geometry.radius) / speed /
+                    REPORTING_BOUNDARY_REPORTS)
+        return REPORTING_INTERVALS[
+            max(bisect_right(REPORTING_INTERVALS, interval) - 1, 0)]
+
+    def rebuild_device_cache(self, slots=None, distances=None):
+        """ Recalculate the cached location of every device
+
+        slots are the position store slots of the devices and distances
+        their distances to the monitored zone, if they are already known.
+        """
+        if slots is None:
+            slots = [self.positions.update(device,
+                                           self.hass.states.get(device))
+                     for device in self.proximity_devices]
+
+        # calculate the distances from the monitored zone to every device in
+        # one batch, ignored zones are only calculated when needed
+        if distances is None:
+            latitudes, longitudes = self.positions.positions(slots)
+            distances = zone_distances(self.zone_geometry, latitudes,
+                                       longitudes)
+
+        records = {}
+        nearest_order = []
+        devices_in_zone = set()
+        for device, slot, dist_to_zone in zip(self.proximity_devices, slots,
+                                              distances):
+            distance_row = None
+            if not math.isnan(dist_to_zone):
+                distance_row = {self.proximity_zone: dist_to_zone}
+            record = self.locate_device(slot, distance_row,
+                                        device in self.devices_in_zone)
+            self.add_to_trend(record, self.positions.timestamps[slot])
+            record.reporting_interval = self.reporting_interval(record)
+            records[device] = record
+            if record.status == DEVICE_IN_ZONE:
+                devices_in_zone.add(device)
+            elif record.status == DEVICE_ELIGIBLE:
+                nearest_order.append(self.nearest_key(device, record))
+        nearest_order.sort()
+
+        self.device_cache = records
+        self.nearest_order = nearest_order
+        self.devices_in_zone = devices_in_zone
+
+    def evaluate_proximity(self, entities=()):
+        """ Work out the state of the entity from the cached devices
+
+        entities are the devices that triggered the evaluation, if any.
+        Returns a dictionary of the entity values, or None if the entity
+        should not be updated.
+        """
+        # devices in the monitored zone, in configuration order
+        devices_in_zone = [self.device_cache[device].name
+                           for device in sorted(self.devices_in_zone,
+                                                key=self.device_order.get)]
+
+        # the k nearest devices, devices in the zone come first
+        nearest_devices = [{ATTR_NEAREST: name, ATTR_DIST_FROM: 0}
+                           for name in devices_in_zone]
+        for device_dist, _, device in self.nearest_order[
+                :max(self.nearest_count - len(nearest_devices), 0)]:
+            nearest_devices.append({
+                ATTR_NEAREST: self.device_cache[device].name,
+                ATTR_DIST_FROM: device_dist})
+        nearest_devices = nearest_devices[:self.nearest_count]
+
+        reporting_intervals = dict(
+            (device, record.reporting_interval)
+            for device, record in self.device_cache.items()
+            if record.reporting_interval is not None)
+
+        # at least one device is in the monitored zone
+        if devices_in_zone:
+            return {
+                'dist_to': 0,
+                'dir_of_travel': 'arrived',
+                'nearest': ', '.join(devices_in_zone),
+                'speed': 0,
+                'smoothed_dir_of_travel': 'arrived',
+                'eta': 0,
+                'nearest_devices': nearest_devices,
+                'reporting_intervals': reporting_intervals
+            }
 
         # no-one to track so reset the entity
-        if not devices_to_calculate or not devices_have_coordinates:
-            self.dist_to = 'not set'
-            self.dir_of_travel = 'not set'
-            self.nearest = 'not set'
-            self.update_ha_state()
-            return
+        if not self.nearest_order:
+            return {
+                'dist_to': 'not set',
+                'dir_of_travel': 'not set',
+                'nearest': 'not set',
+                'speed': 'not set',
+                'smoothed_dir_of_travel': 'not set',
+                'eta': 'not set',
+                'nearest_devices': 'not set',
+                'reporting_intervals': reporting_intervals
+            }
+
+        dist_to_zone, _, closest_device = self.nearest_order[0]
 
         # we can't check proximity because latitude and longitude don't exist
-        if 'latitude' not in new_state.attributes:
-            return
+        if entities and all(self.device_cache[entity].status ==
+                            DEVICE_NO_COORDINATES for entity in entities):
+            return None
+
+        closest_record = self.device_cache[closest_device]
+        result = {
+            'dist_to': round(dist_to_zone),
+            'dir_of_travel': 'unknown',
+            'nearest': closest_record.name,
+            'speed': 'unknown',
+            'smoothed_dir_of_travel': 'unknown',
+            'eta': 'unknown',
+            'nearest_devices': nearest_devices,
+            'reporting_intervals': reporting_intervals
+        }
 
-        # collect distances to the zone for all devices
-        distances_to_zone = {}
-        for device in self.proximity_devices:
-            # ignore devices in an ignored zone
-            device_state = self.hass.states.get(device)
+        # estimate the speed and direction from the recent distances
+        trend = closest_record.trend
+        if trend is not None and trend.slope is not None:
+            result['speed'] = round(abs(trend.slope) * 3.6, 1)
+            result['smoothed_dir_of_travel'] = self.direction_of_travel(
+                trend.slope * trend.span)
+
+            # time to reach the edge of the zone at the current speed
+            if result['smoothed_dir_of_travel'] == 'towards':
+                result['eta'] = round(
+                    max(closest_record.distance -
+                        self.zone_geometry.radius, 0) /
+                    -trend.slope / 60)
+
+        # if the closest device is one of the other devices, or we cannot
+        # calculate the direction of travel (i.e. we don't have a previous
+        # distance for the device)
+        if (closest_device not in entities or
+                closest_record.last_distance is None):
+            return result
+
+        # calculate the distance travelled since the device was last located
+        distance_travelled = (closest_record.distance -
+                              closest_record.last_distance)
+
+        # recalculate the exact distances when the approximations are too
+        # close to the tolerance to be sure of the direction
+        error = closest_record.error + closest_record.last_error
+        if error and (abs(abs(distance_travelled) - self.tolerance) <=
+                      error + 0.05):
+            distance_travelled = (
+                zone_haversine(self.zone_geometry, closest_record.latitude,
+                               closest_record.longitude) -
+                zone_haversine(self.zone_geometry,
+                               closest_record.last_latitude,
+                               closest_record.last_longitude))
+
+        result['dir_of_travel'] = self.direction_of_travel(distance_travelled)
+        return result
+
+    def direction_of_travel(self, distance_travelled):
+        """ Direction of travel for a change in distance to the zone """
+        distance_travelled = round(distance_travelled, 1)
 
-            # ignore devices if proximity cannot be calculated
-            if 'latitude' not in device_state.attributes:
-                continue
+        # check for tolerance
+        if distance_travelled < self.tolerance * -1:
+            return 'towards'
+        elif distance_travelled > self.tolerance:
+            return 'away_from'
+        return 'stationary'
+
+    def update_proximity(self, result):
+        """ Update the entity from an evaluation result
+
+        The state is only written if the result has changed significantly,
+        a significant change within the minimum interval is written once the
+        interval has passed. Returns True if the entity has been updated.
+        """
+        with self.publish_lock:
+            if (all(getattr(self, key) == value
+                    for key, value in result.items())
+                    or not self.is_significant(result)):
+                self.pending_result = None
+                self.suppressed_updates += 1
+                return False
+
+            delay = self.publication_delay(result)
+            if delay:
+                self.suppressed_updates += 1
+                self.defer_proximity(result, delay)
+                return False
+
+            self.write_proximity(result)
+            return True
+
+    def is_significant(self, result):
+        """ Check if a changed result is large enough to be published under
+        the publication policy """
+        if not self.min_delta:
+            return True
+
+        if self.publish_on_change and self.changes_course(result):
+            return True
+
+        try:
+            return abs(result['dist_to'] - self.dist_to) >= self.min_delta
+        except TypeError:
+            # a distance that is not set or unknown is always significant
+            return True
+
+    def changes_course(self, result):
+        """ Check if a result changes the direction of travel or the nearest
+        device """
+        return (result['dir_of_travel'] != self.dir_of_travel or
+                result['nearest'] != self.nearest)
+
+    def publication_delay(self, result):
+        """ Seconds left of the minimum interval before a result can be
+        published """
+        if not self.min_interval or self.last_published is None:
+            return 0
+
+        if self.publish_on_change and self.changes_course(result):
+            return 0
+
+        return max(self.last_published + self.min_interval -
+                   dt_util.utcnow().timestamp(), 0)
+
+    def defer_proximity(self, result, delay):
+        """ Hold a result back until the minimum interval has passed """
+        with self.publish_lock:
+            self.pending_result = result
+            if self.publish_scheduled:
+                return
+
+            self.publish_scheduled = True
+            track_point_in_utc_time(
+                self.hass, self.publish_pending,
+                dt_util.utcnow() + timedelta(seconds=delay))
+
+    def publish_pending(self, now=None):
+        """ Write the result held back by the minimum interval """
+        # pylint: disable=unused-argument
+        with self.publish_lock:
+            self.publish_scheduled = False
+            result = self.pending_result
+            if result is None:
+                return
+
+            self.write_proximity(result)
+
+    def write_proximity(self, result):
+        """ Write an evaluation result to the entity """
+        with self.publish_lock:
+            for key, value in result.items():
+                setattr(self, key, value)
+            self.pending_result = None
+            self.last_published = dt_util.utcnow().timestamp()
+            self.update_ha_state()
 
-            device_state_lat = device_state.attributes['latitude']
-            device_state_lon = device_state.attributes['longitude']
-
-            device_in_ignored_zone = False
-            for ignored_zone in self.ignored_zones:
-                ignored_zone_state = self.hass.states.get('zone.' +
-                                                          ignored_zone)
-                if zone.in_zone(ignored_zone_state,
-                                device_state_lat,
-                                device_state_lon):
-                    device_in_ignored_zone = True
-                    continue
-            if device_in_ignored_zone:
-                continue
+    def device_has_moved(self, entity, new_state):
+        """ Check if a device moved further than the minimum movement """
+        if new_state is None or 'latitude' not in new_state.attributes:
+            return True
 
-            # calculate the distance to the proximity zone
-            dist_to_zone = distance(proximity_latitude,
-                                    proximity_longitude,
-                                    device_state_lat,
-                                    device_state_lon)
-
-            # add the device and distance to a dictionary
-            distances_to_zone[device] = round(dist_to_zone / 1000, 1)
-
-        # loop through each of the distances collected and work out the closest
-        closest_device = ''
-        dist_to_zone = 1000000
-
-        for device in distances_to_zone:
-            if distances_to_zone[device] < dist_to_zone:
-                closest_device = device
-                dist_to_zone = distances_to_zone[device]
-
-        # if the closest device is one of the other devices
-        if closest_device != entity:
-            self.dist_to = round(distances_to_zone[closest_device])
-            self.dir_of_travel = 'unknown'
-            device_state = self.hass.states.get(closest_device)
-            self.nearest = device_state.name
-            self.update_ha_state()
+        return self.position_has_moved(
+            entity, (new_state.attributes['latitude'],
+                     new_state.attributes['longitude']))
+
+    def position_has_moved(self, entity, position):
+        """ Check if a device moved further than the minimum movement to
+        a position, None is a position without coordinates """
+        record = self.device_cache.get(entity)
+        if (not self.min_movement or record is None or
+                record.latitude is None or position is None):
+            return True
+
+        return haversine(record.latitude, record.longitude,
+                         position[0], position[1]) >= self.min_movement
+
+    def check_proximity_state_change(self, entity, old_state, new_state):
+        """ Function to perform the proximity checking """
+        # pylint: disable=unused-argument
+        # ignore jitter around the last evaluated position
+        if not self.device_has_moved(entity, new_state):
             return
 
-        # stop if we cannot calculate the direction of travel (i.e. we don't
-        # have a previous state and a current LAT and LONG)
-        if old_state is None or 'latitude' not in old_state.attributes:
-            self.dist_to = round(distances_to_zone[entity])
-            self.dir_of_travel = 'unknown'
-            self.nearest = entity_name
-            self.update_ha_state()
+        self.apply_state_change(entity, new_state)
+
+    def check_proximity_batch(self, updates):
+        """ Function to perform the proximity checking for many devices
+
+        updates are (entity, new_state) pairs in the order they happened,
+        the entity is evaluated and written once for all of them.
+        """
+        entities = [entity for entity, new_state in updates
+                    if self.device_has_moved(entity, new_state) and
+                    self.update_device(entity, new_state)]
+        self.publish_proximity(entities)
+
+    def update_device(self, entity, new_state, zone_distances=None):
+        """ Update the cache for a device that has moved, returns True if
+        the device is tracked by the proximity """
+        if entity not in self.device_order:
+            return False
+
+        # only the device that changed needs to be recalculated
+        self.update_device_cache(entity, new_state, zone_distances)
+        return True
+
+    def apply_state_change(self, entity, new_state, zone_distances=None):
+        """ Update the proximity for a device that has moved """
+        if self.update_device(entity, new_state, zone_distances):
+            self.publish_proximity([entity])
+
+    def publish_proximity(self, entities):
+        """ Evaluate the entity once for the devices that have changed """
+        if not entities:
             return
 
-        # reset the variables
-        distance_travelled = 0
+        self.publish_result(self.evaluate_proximity(entities), entities)
 
-        # calculate the distance travelled
-        old_distance = distance(proximity_latitude, proximity_longitude,
-                                old_state.attributes['latitude'],
-                                old_state.attributes['longitude'])
-        new_distance = distance(proximity_latitude, proximity_longitude,
-                                new_state.attributes['latitude'],
-                                new_state.attributes['longitude'])
-        distance_travelled = round(new_distance - old_distance, 1)
+    def publish_result(self, result, entities):
+        """ Write an evaluation result for the devices that have changed """
+        if result is None:
+            return
 
-        # check for tolerance
-        if distance_travelled < self.tolerance * -1:
-            direction_of_travel = 'towards'
-        elif distance_travelled > self.tolerance:
-            direction_of_travel = 'away_from'
-        else:
-            direction_of_travel = 'stationary'
+        if not self.update_proximity(result):
+            return
 
-        # update the proximity entity
-        self.dist_to = round(dist_to_zone)
-        self.dir_of_travel = direction_of_travel
-        self.nearest = entity_name
-        self.update_ha_state()
         _LOGGER.debug('proximity.%s update entity: distance=%s: direction=%s: '
-                      'device=%s', self.friendly_name, round(dist_to_zone),
-                      direction_of_travel, entity_name)
+                      'device=%s', self.friendly_name, self.dist_to,
+                      self.dir_of_travel, self.nearest)
 
-        _LOGGER.info('%s: proximity calculation complete', entity_name)
+        _LOGGER.info('%s: proximity calculation complete', ', '.join(entities))
 
     def check_proximity_initial_state(self):
-        # pylint: disable=too-many-branches,too-many-statements,too-many-locals
         """ Function to perform the proximity checking in the initial state """
-        devices_to_calculate = self.ignored_zones == []
-        devices_have_coordinates = False
-        devices_in_zone = ''
+        self.rebuild_device_cache()
+        self.update_proximity(self.evaluate_proximity())
 
-        zone_state = self.hass.states.get(self.proximity_zone)
-        proximity_latitude = zone_state.attributes.get('latitude')
-        proximity_longitude = zone_state.attributes.get('longitude')
 
-        # check for devices in the monitored zone
-        for device in self.proximity_devices:
-            device_state = self.hass.states.get(device)
+class ProximityEngine(object):
+    """ Shares device to zone distances between all the proximities
 
-            if 'latitude' not in device_state.attributes:
-                continue
+    Device updates wait in a mailbox that only keeps the latest update of
+    each device, so updates that are replaced while the engine is busy or
+    within batch_window seconds of each other are never applied. The
+    waiting updates are applied together, so each proximity is written once
+    for all of them.
+    """
+    def __init__(self, hass, batch_window=DEFAULT_BATCH_WINDOW):
+        self.hass = hass
+        self.batch_window = batch_window
+        self.positions = PositionStore()
+        self.mailbox = {}
+        self.working = False
+        self.stopped = False
+        self.dropped_updates = 0
+        self.lock = threading.Lock()
+        # device batches and zone changes are applied one at a time
+        self.update_lock = threading.Lock()
+        self.proximities = []
+        self.zone_geometry = {}
+        # proximities interested in each device and zone
+        self.device_index = {}
+        self.zone_index = {}
 
-            devices_have_coordinates = True
-
-            device_state_lat = device_state.attributes['latitude']
-            device_state_lon = device_state.attributes['longitude']
-
-            for ignored_zone in self.ignored_zones:
-                ignored_zone_state = self.hass.states.get('zone.' +
-                                                          ignored_zone)
-                if not zone.in_zone(ignored_zone_state,
-                                    device_state_lat,
-                                    device_state_lon):
-                    devices_to_calculate = True
-
-            # check the location of all devices
-            if zone.in_zone(zone_state,
-                            device_state_lat,
-                            device_state_lon):
-                device_friendly = device_state.name
-                if devices_in_zone != '':
-                    devices_in_zone = devices_in_zone + ', '
-                devices_in_zone = devices_in_zone + device_friendly
-
-        # at least one device is in the monitored zone so update the entity
-        if devices_in_zone != '':
-            self.dist_to = 0
-            self.dir_of_travel = 'arrived'
-            self.nearest = devices_in_zone
-            self.update_ha_state()
-            return
+    @property
+    def devices(self):
+        """ Entity ids of the devices tracked by any proximity """
+        return list(self.device_index)
 
-        # no-one to track so reset the entity
-        if not devices_to_calculate or not devices_have_coordinates:
-            self.dist_to = 'not set'
-            self.dir_of_travel = 'not set'
-            self.nearest = 'not set'
-            self.update_ha_state()
+    @property
+    def zones(self):
+        """ Entity ids of the zones used by any proximity """
+        return list(self.zone_index)
+
+    def add_proximity(self, proximity):
+        """ Add a proximity to the engine """
+        proximity.positions = self.positions
+        self.proximities.append(proximity)
+        for device in proximity.proximity_devices:
+            self.device_index.setdefault(device, []).append(proximity)
+        for zone_entity in proximity.zone_entities:
+            self.zone_index.setdefault(zone_entity, []).append(proximity)
+        self.update_zone_geometry()
+
+    def start(self):
+        """ Start the engine once all the proximities are added """
+
+    def stop(self, event=None):
+        """ Stop the engine, device updates that arrive later or are still
+        waiting are ignored """
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.stopped = True
+            self.mailbox = {}
+
+    def check_initial_state(self):
+        """ Locate every device for every proximity and write each entity
+
+        The distances from every device to every monitored zone are
+        calculated in a single pass over a devices by zones matrix.
+        """
+        devices = self.devices
+        slots = [self.positions.update(device, self.hass.states.get(device))
+                 for device in devices]
+        zone_table = [self.zone_geometry[zone_entity] for zone_entity in
+                      set(proximity.proximity_zone
+                          for proximity in self.proximities)]
+        latitudes, longitudes = self.positions.positions(slots)
+        matrix = distance_matrix(zone_table, latitudes, longitudes)
+
+        rows = dict(zip(devices, range(len(devices))))
+        columns = dict((geometry.entity_id, column)
+                       for column, geometry in enumerate(zone_table))
+        for proximity in self.proximities:
+            device_rows = [rows[device]
+                           for device in proximity.proximity_devices]
+            column = columns[proximity.proximity_zone]
+            proximity.rebuild_device_cache(
+                [slots[row] for row in device_rows],
+                [float(matrix[row][column]) for row in device_rows])
+            proximity.write_proximity(proximity.evaluate_proximity())
+
+    def update_zone_geometry(self):
+        """ Collect the zone geometry of all the proximities """
+        zone_geometry = {}
+        for proximity in self.proximities:
+            for geometry in proximity.zone_table:
+                zone_geometry[geometry.entity_id] = geometry
+        self.zone_geometry = zone_geometry
+
+    def measure_zones(self, latitude, longitude, proximities):
+        """ Calculate the distances from a coordinate to the monitored zones
+        of the proximities, each zone is only calculated once
+
+        Proximities in the fast mode approximate their own distances, so
+        their zones are left out unless an exact proximity shares them.
+        """
+        zone_entities = set(proximity.proximity_zone
+                            for proximity in proximities
+                            if proximity.distance_mode != DISTANCE_FAST)
+        zone_table = [self.zone_geometry[zone_entity]
+                      for zone_entity in zone_entities]
+
+        distances = batch_distance(
+            latitude, longitude,
+            [geometry.latitude for geometry in zone_table],
+            [geometry.longitude for geometry in zone_table])
+        return dict(zip([geometry.entity_id for geometry in zone_table],
+                        distances))
+
+    def state_changed_listener(self, event):
+        """ Dispatch a state change to the proximities interested in it """
+        if self.stopped:
             return
 
-        # collect distances to the zone for all devices
-        distances_to_zone = {}
-        for device in self.proximity_devices:
-            # ignore devices in an ignored zone
-            device_state = self.hass.states.get(device)
-
-            # ignore devices if proximity cannot be calculated
-            if 'latitude' not in device_state.attributes:
+        entity = event.data['entity_id']
+        if entity in self.device_index:
+            self.post_device_update(entity, event.data['new_state'])
+        elif entity in self.zone_index:
+            with self.update_lock:
+                self.check_zone_state_change(entity, event.data['old_state'],
+                                             event.data['new_state'])
+
+    def post_device_update(self, entity, new_state):
+        """ Put a device update in the mailbox, replacing any update of the
+        device that is still waiting """
+        with self.lock:
+            if self.stopped:
+                return
+            if entity in self.mailbox:
+                self.dropped_updates += 1
+                for proximity in self.device_index.get(entity, ()):
+                    proximity.dropped_updates += 1
+            self.mailbox[entity] = new_state
+            if self.working:
+                return
+            self.working = True
+
+        if self.batch_window:
+            track_point_in_utc_time(
+                self.hass, self.flush_device_updates,
+                dt_util.utcnow() + timedelta(seconds=self.batch_window))
+        else:
+            self.process_mailbox()
+
+    def flush_device_updates(self, now=None):
+        """ Apply the device updates held in the batch window """
+        # pylint: disable=unused-argument
+        self.process_mailbox()
+
+    def process_mailbox(self):
+        """ Apply the waiting device updates until the mailbox is empty,
+        updates posted meanwhile are picked up by the same worker """
+        try:
+            while True:
+                with self.lock:
+                    if not self.mailbox:
+                        self.working = False
+                        return
+                    updates = list(self.mailbox.items())
+                    self.mailbox = {}
+                with self.update_lock:
+                    self.check_device_batch(updates)
+        except Exception:
+            # let the next update start a new worker
+            with self.lock:
+                self.working = False
+            raise
+
+    def check_device_state_change(self, entity, old_state, new_state):
+        """ Function to update all the proximities tracking a device """
+        # pylint: disable=unused-argument
+        with self.update_lock:
+            self.check_device_batch([(entity, new_state)])
+
+    def check_device_batch(self, updates):
+        """ Function to update all the proximities tracking the devices
+
+        updates are (entity, new_state) pairs in the order they happened,
+        each proximity is evaluated once for all of them.
+        """
+        changed = {}
+        for entity, new_state in updates:
+            proximities = [proximity
+                           for proximity in self.device_index.get(entity, ())
+                           if proximity.device_has_moved(entity, new_state)]
+            if not proximities:
                 continue
 
-            device_state_lat = device_state.attributes['latitude']
-            device_state_lon = device_state.attributes['longitude']
-
-            device_in_ignored_zone = False
-            for ignored_zone in self.ignored_zones:
-                ignored_zone_state = self.hass.states.get('zone.' +
-                                                          ignored_zone)
-                if zone.in_zone(ignored_zone_state,
-                                device_state_lat,
-                                device_state_lon):
-                    device_in_ignored_zone = True
-                    continue
-            if device_in_ignored_zone:
-                continue
+            # every proximity reads the device from the shared store
+            slot = self.positions.update(entity, new_state)
+            position = self.positions.position(slot)
+            zone_distances = None
+            if position is not None:
+                zone_distances = self.measure_zones(position[0], position[1],
+                                                    proximities)
+
+            for proximity in proximities:
+                proximity.relocate_device(entity, slot, zone_distances)
+                changed.setdefault(proximity.entity_id,
+                                   (proximity, []))[1].append(entity)
+
+        for proximity, entities in changed.values():
+            proximity.publish_proximity(entities)
+
+    def check_zone_state_change(self, entity, old_state, new_state):
+        """ Function to update all the proximities using a zone """
+        for proximity in self.zone_index.get(entity, ()):
+            proximity.check_zone_state_change(entity, old_state, new_state)
+        self.update_zone_geometry()
+
+
+class ShardedProximityEngine(ProximityEngine):
+    """ Evaluates the proximities in worker processes
+
+    The proximities are split between the workers, and the device positions
+    are published through a shared position store. Only device slots and
+    evaluation results cross the process boundaries, and the entities are
+    written from Home Assistant. If a worker fails the workers are stopped
+    and the proximities are evaluated in Home Assistant instead.
+    """
+    def __init__(self, hass, batch_window=DEFAULT_BATCH_WINDOW,
+                 workers=DEFAULT_ENGINE_WORKERS):
+        super().__init__(hass, batch_window)
+        self.workers = workers
+        self.connections = []
+        self.processes = []
+        self.shards = {}
+        self.device_shards = {}
+        self.shard_lock = threading.Lock()
+        # set once a worker failed and the workers are no longer used
+        self.in_process = False
+
+    def start(self):
+        """ Start the worker processes and load their proximities """
+        self.positions = SharedPositionStore.from_store(self.positions)
+        context = multiprocessing.get_context('spawn')
+        for _ in range(self.workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=shard_worker, daemon=True,
+                args=(worker_connection, self.positions.block_names,
+                      len(self.positions.latitudes)))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        for index, proximity in enumerate(self.proximities):
+            proximity.positions = self.positions
+            shard = index % self.workers
+            self.shards[proximity.entity_id] = shard
+            for device in proximity.device_order:
+                self.device_shards.setdefault(device, set()).add(shard)
+        self.load_proximities(self.proximities)
+
+        self.hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, self.stop)
+
+    def stop(self, event=None):
+        """ Stop the worker processes and free the shared memory """
+        # pylint: disable=unused-argument
+        super().stop()
+        with self.shard_lock:
+            self.stop_workers()
+
+    def stop_workers(self):
+        """ Stop the worker processes as far as they still answer and free
+        the shared memory, called with the shard lock held """
+        if not self.processes:
+            return
+
+        connections, self.connections = self.connections, []
+        processes, self.processes = self.processes, []
+        try:
+            for connection in connections:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                connection.close()
+            for process in processes:
+                process.join(WORKER_STOP_TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+        finally:
+            self.positions.close(unlink=True)
+
+    def fall_back(self, shard, error):
+        """ Stop the workers after a worker failed and evaluate every
+        proximity in Home Assistant, called with the shard lock held """
+        _LOGGER.error('proximity engine worker %s failed (%s), evaluating '
+                      'the proximities in Home Assistant', shard, error)
+        self.in_process = True
+        self.stop_workers()
+        self.positions = PositionStore()
+        for proximity in self.proximities:
+            proximity.positions = self.positions
+            proximity.check_proximity_initial_state()
+
+    def load_proximities(self, proximities):
+        """ Copy proximities to the workers that evaluate them """
+        shard_proximities = {}
+        for proximity in proximities:
+            shard_proximities.setdefault(self.shards[proximity.entity_id],
+                                         []).append(proximity)
+        with self.shard_lock:
+            if self.stopped or self.in_process:
+                return
+            for shard, payload in shard_proximities.items():
+                try:
+                    self.connections[shard].send((SHARD_LOAD, payload))
+                except OSError as error:
+                    self.fall_back(shard, error)
+                    return
+
+    def check_device_batch(self, updates):
+        """ Function to update all the proximities tracking the devices
+
+        The workers evaluate their proximities in parallel and the results
+        are written once they have all answered.
+        """
+        messages = {}
+        results = []
+        with self.shard_lock:
+            # the shared memory is freed once the engine has stopped
+            if self.stopped:
+                return
+            if not self.in_process:
+                for entity, new_state in updates:
+                    slot = self.positions.update(entity, new_state)
+                    for shard in self.device_shards.get(entity, ()):
+                        messages.setdefault(shard, []).append(
+                            (entity, slot, self.positions.names[slot]))
+                shard = None
+                try:
+                    for shard, payload in messages.items():
+                        self.connections[shard].send((SHARD_UPDATE, payload))
+                    for shard in messages:
+                        results.extend(self.connections[shard].recv())
+                except (EOFError, OSError) as error:
+                    # the proximities are rebuilt from the current states,
+                    # which already include these updates
+                    self.fall_back(shard, error)
+                    return
+
+        if self.in_process:
+            super().check_device_batch(updates)
+            return
 
-            # calculate the distance to the proximity zone
-            dist_to_zone = distance(proximity_latitude,
-                                    proximity_longitude,
-                                    device_state_lat,
-                                    device_state_lon)
-
-            # add the device and distance to a dictionary
-            distances_to_zone[device] = round(dist_to_zone / 1000, 1)
-
-        # loop through each of the distances collected and work out the closest
-        closest_device = ''
-        dist_to_zone = 1000000
-
-        for device in distances_to_zone:
-            if distances_to_zone[device] < dist_to_zone:
-                closest_device = device
-                dist_to_zone = distances_to_zone[device]
-
-        self.dist_to = round(distances_to_zone[closest_device])
-        self.dir_of_travel = 'unknown'
-        device_state = self.hass.states.get(closest_device)
-        self.nearest = device_state.name
-        self.update_ha_state()
+        proximities = dict((proximity.entity_id, proximity)
+                           for proximity in self.proximities)
+        for entity_id, result, entities in results:
+            proximities[entity_id].publish_result(result, entities)
+
+    def check_zone_state_change(self, entity, old_state, new_state):
+        """ Function to update all the proximities using a zone """
+        with self.shard_lock:
+            if self.stopped:
+                return
+            super().check_zone_state_change(entity, old_state, new_state)
+            if self.in_process:
+                return
+        self.load_proximities(self.zone_index.get(entity, ()))
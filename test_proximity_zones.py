@@ -7,12 +7,16 @@ Tests proximity_zones component.
 
 import homeassistant.core as ha
 import os
+import random
+import threading
 from homeassistant.components import proximity_zones
 from homeassistant.components import zone
+from homeassistant.util.location import distance
+from homeassistant.const import EVENT_STATE_CHANGED
 import homeassistant.components.device_tracker as device_tracker
 import homeassistant.util.dt as dt_util
 from datetime import datetime, timedelta
-from tests.common import get_test_home_assistant
+from tests.common import get_test_home_assistant, fire_time_changed
 
 class TestProximityZones:
     """ Test the Proximity_zones component. """
@@ -1082,3 +1086,1399 @@ class TestProximityZones:
         state = self.hass.states.get('proximity_zones.home')
         assert state.attributes.get('nearest') == 'test1'
         assert state.attributes.get('dir_of_travel') == 'unknown'
+
+    def test_batch_distance_matches_scalar_distance(self):
+        latitudes = [2.1 + i for i in range(20)]
+        longitudes = [1.1 + i / 2 for i in range(20)]
+        distances = proximity_zones.batch_distance(2.1, 1.1, latitudes,
+                                                   longitudes)
+        assert len(distances) == 20
+        assert distances[0] == 0
+        for lat, lon, dist in zip(latitudes, longitudes, distances):
+            expected = distance(2.1, 1.1, lat, lon)
+            assert abs(dist - expected) <= expected * 0.005
+
+    def test_batch_distance_without_numpy(self):
+        numpy_module = proximity_zones.np
+        proximity_zones.np = None
+        try:
+            distances = proximity_zones.batch_distance(
+                2.1, 1.1, [20.1] * 10, [10.1] * 10)
+        finally:
+            proximity_zones.np = numpy_module
+        assert distances == [proximity_zones.haversine(
+            2.1, 1.1, 20.1, 10.1)] * 10
+
+    def test_state_change_only_recalculates_changed_device(self):
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', ['work'],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+        assert proximity.device_cache['device_tracker.test2'].latitude == 50
+
+        # the proximity is not listening so test2 moving is not seen
+        self.hass.states.set(
+            'device_tracker.test2', 'not_home',
+            {
+                'friendly_name': 'test2',
+                'latitude': 10.1,
+                'longitude': 5.1
+            })
+        old_state = self.hass.states.get('device_tracker.test1')
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        proximity.check_proximity_state_change(
+            'device_tracker.test1', old_state,
+            self.hass.states.get('device_tracker.test1'))
+
+        assert proximity.device_cache['device_tracker.test1'].latitude == 20.1
+        assert proximity.device_cache['device_tracker.test2'].latitude == 50
+        assert proximity.nearest == 'test1'
+        assert proximity.dir_of_travel == 'towards'
+
+    def test_zone_change_recalculates_proximity(self):
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'ignored_zones': {
+                        'work'
+                    },
+                    'devices': {
+                        'test1'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('dir_of_travel') == 'unknown'
+
+        self.hass.states.set(
+            'zone.home', 'zoning',
+            {
+                'friendly_name': 'home',
+                'latitude': 50,
+                'longitude': 50,
+                'radius': 10
+            })
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.state == '0'
+        assert state.attributes.get('nearest') == 'test1'
+        assert state.attributes.get('dir_of_travel') == 'arrived'
+
+        self.hass.states.set(
+            'zone.work', 'zoning',
+            {
+                'friendly_name': 'work',
+                'latitude': 20.1,
+                'longitude': 10.1,
+                'radius': 10
+            })
+        self.hass.states.set(
+            'device_tracker.test1', 'work',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.state == 'not set'
+        assert state.attributes.get('nearest') == 'not set'
+
+    def test_device_tracker_in_one_of_several_ignored_zones(self):
+        self.hass.states.set(
+            'zone.school', 'zoning',
+            {
+                'friendly_name': 'school',
+                'latitude': 20.1,
+                'longitude': 10.1,
+                'radius': 10
+            })
+        self.hass.states.set(
+            'device_tracker.test1', 'school',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        self.hass.pool.block_till_done()
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'ignored_zones': [
+                        'work',
+                        'school'
+                    ],
+                    'devices': {
+                        'test1'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.state == 'not set'
+        assert state.attributes.get('nearest') == 'not set'
+        assert state.attributes.get('dir_of_travel') == 'not set'
+
+    def test_device_tracker_in_zone_overlapping_ignored_zone(self):
+        self.hass.states.set(
+            'zone.garden', 'zoning',
+            {
+                'friendly_name': 'garden',
+                'latitude': 2.1,
+                'longitude': 1.1,
+                'radius': 100
+            })
+        self.hass.states.set(
+            'device_tracker.test1', 'home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 2.1,
+                'longitude': 1.1
+            })
+        self.hass.pool.block_till_done()
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'ignored_zones': [
+                        'garden'
+                    ],
+                    'devices': {
+                        'test1',
+                        'test2'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.state == '0'
+        assert state.attributes.get('nearest') == 'test1'
+        assert state.attributes.get('dir_of_travel') == 'arrived'
+
+    def test_unchanged_proximity_is_not_written(self):
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'devices': {
+                        'test1'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+
+        for tracker_state in ('away', 'still_away', 'not_home'):
+            self.hass.states.set(
+                'device_tracker.test1', tracker_state,
+                {
+                    'friendly_name': 'test1',
+                    'latitude': 50,
+                    'longitude': 50
+                })
+            self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('dir_of_travel') == 'stationary'
+        assert state.attributes.get('suppressed_updates') == 0
+
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('dir_of_travel') == 'towards'
+        assert state.attributes.get('suppressed_updates') == 2
+
+    def test_device_tracker_movement_below_min_movement(self):
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'devices': {
+                        'test1'
+                    },
+                    'tolerance': 1,
+                    'min_movement_m': 50
+                }
+            }
+        })
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('dir_of_travel') == 'unknown'
+
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 50.0001,
+                'longitude': 50.0001
+            })
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('dir_of_travel') == 'unknown'
+
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('dir_of_travel') == 'towards'
+
+    def test_engine_measures_device_once_for_all_proximities(self):
+        engine = proximity_zones.ProximityEngine(self.hass)
+        for name, proximity_zone, ignored_zones in (
+                ('home', 'zone.home', ['work']),
+                ('work', 'zone.work', ['home'])):
+            proximity = proximity_zones.Proximity(
+                self.hass, name, 'not set', 'not set', 'not set',
+                ignored_zones,
+                ['device_tracker.test1', 'device_tracker.test2'], 1,
+                proximity_zone, name)
+            proximity.entity_id = 'proximity_zones.' + name
+            proximity.check_proximity_initial_state()
+            engine.add_proximity(proximity)
+        assert sorted(engine.devices) == ['device_tracker.test1',
+                                          'device_tracker.test2']
+        assert sorted(engine.zones) == ['zone.home', 'zone.work']
+
+        calls = []
+        batch_distance = proximity_zones.batch_distance
+
+        def counting_batch_distance(*args):
+            """ Count the calls to the batch distance engine. """
+            calls.append(args)
+            return batch_distance(*args)
+
+        old_state = self.hass.states.get('device_tracker.test1')
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        proximity_zones.batch_distance = counting_batch_distance
+        try:
+            engine.check_device_state_change(
+                'device_tracker.test1', old_state,
+                self.hass.states.get('device_tracker.test1'))
+        finally:
+            proximity_zones.batch_distance = batch_distance
+
+        assert len(calls) == 1
+        assert len(calls[0][2]) == 2
+        assert engine.proximities[0].nearest == 'test1'
+        assert engine.proximities[0].dir_of_travel == 'towards'
+
+        # the work zone is at latitude 100, which haversine places at
+        # latitude 80 on the opposite meridian, where test2 is still closer
+        assert engine.proximities[1].nearest == 'test2'
+        assert engine.proximities[1].dist_to == round(
+            proximity_zones.haversine(80, -80, 50, 50) / 1000)
+        assert engine.proximities[1].dir_of_travel == 'unknown'
+
+    def test_engine_dispatches_state_changes_by_entity(self):
+        engine = proximity_zones.ProximityEngine(self.hass)
+        proximities = {}
+        for name, devices in (('home', ['device_tracker.test1']),
+                              ('work', ['device_tracker.test1',
+                                        'device_tracker.test2'])):
+            proximity = proximity_zones.Proximity(
+                self.hass, name, 'not set', 'not set', 'not set', [],
+                devices, 1, 'zone.' + name, name)
+            proximity.entity_id = 'proximity_zones.' + name
+            engine.add_proximity(proximity)
+            proximities[name] = proximity
+
+        assert engine.device_index['device_tracker.test1'] == [
+            proximities['home'], proximities['work']]
+        assert engine.device_index['device_tracker.test2'] == [
+            proximities['work']]
+        assert engine.zone_index['zone.home'] == [proximities['home']]
+
+        self.hass.bus.listen(EVENT_STATE_CHANGED,
+                             engine.state_changed_listener)
+        self.hass.states.set(
+            'device_tracker.test2', 'not_home',
+            {
+                'friendly_name': 'test2',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        self.hass.pool.block_till_done()
+        assert 'device_tracker.test2' not in proximities['home'].device_cache
+        assert proximities['work'].device_cache[
+            'device_tracker.test2'].latitude == 20.1
+
+    def test_engine_applies_zone_changes_between_device_batches(self):
+        engine = proximity_zones.ProximityEngine(self.hass)
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1'], 1, 'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        engine.add_proximity(proximity)
+        engine.check_initial_state()
+
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        check_device_batch = engine.check_device_batch
+        check_zone_state_change = engine.check_zone_state_change
+
+        def slow_device_batch(updates):
+            """ Hold the device batch until it is released. """
+            calls.append('device start')
+            started.set()
+            release.wait(5)
+            check_device_batch(updates)
+            calls.append('device end')
+
+        def zone_state_change(entity, old_state, new_state):
+            """ Record the zone change. """
+            calls.append('zone')
+            check_zone_state_change(entity, old_state, new_state)
+
+        engine.check_device_batch = slow_device_batch
+        engine.check_zone_state_change = zone_state_change
+        device = threading.Thread(
+            target=engine.post_device_update,
+            args=('device_tracker.test1', ha.State(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': 20.1,
+                 'longitude': 1.1})))
+        device.start()
+        assert started.wait(5)
+
+        zone_state = self.hass.states.get('zone.home')
+        zone = threading.Thread(
+            target=engine.state_changed_listener,
+            args=(ha.Event(EVENT_STATE_CHANGED, {
+                'entity_id': 'zone.home', 'old_state': zone_state,
+                'new_state': zone_state}),))
+        zone.start()
+        zone.join(0.2)
+        assert calls == ['device start']
+
+        release.set()
+        device.join(5)
+        zone.join(5)
+        assert calls == ['device start', 'device end', 'zone']
+
+    def test_zone_relations_skip_impossible_zone_checks(self):
+        for name, latitude, longitude, radius in (
+                ('city', 2.1, 1.1, 50000),
+                ('park', 2.1, 1.1, 1000),
+                ('school', 2.2, 1.1, 500),
+                ('airport', 10, 10, 5000),
+                ('gate', 10, 10, 100)):
+            self.hass.states.set(
+                'zone.' + name, 'zoning',
+                {
+                    'friendly_name': name,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'radius': radius
+                })
+        proximity = proximity_zones.Proximity(
+            self.hass, 'city', 'not set', 'not set', 'not set',
+            ['gate', 'park', 'airport', 'school'],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.city', 'city')
+        proximity.entity_id = 'proximity_zones.city'
+
+        assert proximity.zone_relations[('zone.city', 'zone.park')] == \
+            proximity_zones.ZONE_CONTAINS
+        assert proximity.zone_relations[('zone.gate', 'zone.airport')] == \
+            proximity_zones.ZONE_INSIDE
+        assert proximity.zone_relations[('zone.city', 'zone.airport')] == \
+            proximity_zones.ZONE_DISJOINT
+        assert proximity.zones_inside['zone.city'] == frozenset(
+            ['zone.park', 'zone.school'])
+
+        # the distances to the city are calculated in a batch and the
+        # bounding boxes rule out every ignored zone
+        proximity.check_proximity_initial_state()
+        assert proximity.zone_checks == 0
+        assert proximity.dir_of_travel == 'unknown'
+
+        # the zones inside the city are never checked, only the airport
+        # and the distance to the city for the direction of travel
+        proximity.update_device_cache(
+            'device_tracker.test1', ha.State(
+                'device_tracker.test1', 'airport',
+                {'latitude': 10, 'longitude': 10}))
+        assert proximity.zone_checks == 2
+        assert proximity.device_cache['device_tracker.test1'].status == \
+            proximity_zones.DEVICE_IGNORED
+
+    def test_zone_bounding_box(self):
+        geometry = proximity_zones.build_zone_geometry(
+            'zone.home', 60, 10, 10000)
+        assert proximity_zones.in_bounding_box(geometry, 60, 10)
+        assert proximity_zones.in_bounding_box(geometry, 60.08, 10.17)
+        assert not proximity_zones.in_bounding_box(geometry, 60.1, 10)
+        assert not proximity_zones.in_bounding_box(geometry, 60, 10.2)
+
+        # every point inside the zone is inside the box
+        for latitude, longitude in ((60.0895, 10), (60, 10.178),
+                                    (59.9105, 10), (60, 9.822)):
+            assert distance(60, 10, latitude, longitude) < 10000
+            assert proximity_zones.in_bounding_box(geometry, latitude,
+                                                   longitude)
+
+        geometry = proximity_zones.build_zone_geometry(
+            'zone.dateline', 0, 179.99, 10000)
+        assert proximity_zones.in_bounding_box(geometry, 0, -179.99)
+
+        geometry = proximity_zones.build_zone_geometry(
+            'zone.pole', 89.99, 0, 10000)
+        assert proximity_zones.in_bounding_box(geometry, 89.99, 180)
+
+    def test_zone_index_for_many_ignored_zones(self):
+        ignored_zones = []
+        for index in range(12):
+            self.hass.states.set(
+                'zone.school' + str(index), 'zoning',
+                {
+                    'friendly_name': 'school' + str(index),
+                    'latitude': 10 + index,
+                    'longitude': 10 + index,
+                    'radius': 500
+                })
+            ignored_zones.append('school' + str(index))
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set',
+            ignored_zones, ['device_tracker.test1'], 1, 'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+
+        assert proximity.zone_index is not None
+        assert len(proximity.zone_index.zones) == 12
+        assert [geometry.entity_id for geometry in
+                proximity.zone_index.candidates(15, 15)] == ['zone.school5']
+        assert proximity.zone_index.candidates(50, 50) == []
+
+        proximity.update_device_cache(
+            'device_tracker.test1', ha.State(
+                'device_tracker.test1', 'school5',
+                {'latitude': 15, 'longitude': 15}))
+        assert proximity.device_cache['device_tracker.test1'].status == \
+            proximity_zones.DEVICE_IGNORED
+
+        # moving a zone only re-indexes that zone
+        cells = proximity.zone_index.cells
+        school4_cell = proximity.zone_index.cell(14, 14)
+        school4_zones = cells[school4_cell]
+        self.hass.states.set(
+            'zone.school5', 'zoning',
+            {
+                'friendly_name': 'school5',
+                'latitude': 50,
+                'longitude': 50,
+                'radius': 500
+            })
+        proximity.check_zone_state_change(
+            'zone.school5', None, self.hass.states.get('zone.school5'))
+        assert cells[school4_cell] is school4_zones
+        assert proximity.zone_index.candidates(15, 15) == []
+        assert [geometry.entity_id for geometry in
+                proximity.zone_index.candidates(50, 50)] == ['zone.school5']
+
+    def test_direction_of_travel_from_cached_distance(self):
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'devices': {
+                        'test1'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1'
+            })
+        self.hass.pool.block_till_done()
+
+        # the previous state has no coordinates but the distance from the
+        # last known position is cached
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 20.1,
+                'longitude': 10.1
+            })
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('nearest') == 'test1'
+        assert state.attributes.get('dir_of_travel') == 'towards'
+
+    def test_scalar_and_batch_distances_match(self):
+        latitudes = [2.1 + i for i in range(20)]
+        longitudes = [1.1 + i / 2 for i in range(20)]
+        distances = proximity_zones.batch_distance(2.1, 1.1, latitudes,
+                                                   longitudes)
+        for lat, lon, dist in zip(latitudes, longitudes, distances):
+            assert abs(proximity_zones.haversine(2.1, 1.1, lat, lon) -
+                       dist) < 0.001
+
+    def test_distance_trend_estimates_speed(self):
+        trend = proximity_zones.DistanceTrend(size=10)
+        assert trend.slope is None
+        start = 1450000000.0
+        for index in range(25):
+            # approaching at 10 m/s with 5 m of jitter
+            jitter = 5 if index % 2 else -5
+            trend.add(start + index * 5, 20000 - index * 50 + jitter)
+
+        assert trend.count == 10
+        assert trend.span == 45
+        assert abs(trend.slope + 10) < 0.5
+
+        trend.add(start + 125, 18750)
+        assert trend.span == 45
+        assert abs(trend.slope + 10) < 0.5
+
+    def test_proximity_publishes_speed_and_smoothed_direction(self):
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1'], 1, 'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+        assert proximity.speed == 'unknown'
+
+        start = dt_util.utcnow()
+        for index, latitude in enumerate((20.3, 20.2, 20.1, 20.15)):
+            proximity.check_proximity_state_change(
+                'device_tracker.test1', None, ha.State(
+                    'device_tracker.test1', 'not_home',
+                    {'latitude': latitude, 'longitude': 10.1},
+                    last_updated=start + timedelta(minutes=index + 1)))
+
+        # the last fix moved away but the trend is still towards the zone
+        assert proximity.dir_of_travel == 'away_from'
+        assert proximity.smoothed_dir_of_travel == 'towards'
+        assert proximity.speed > 100
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('speed_kmh') == proximity.speed
+        assert state.attributes.get('smoothed_dir_of_travel') == 'towards'
+
+        # time to cover the remaining distance at the estimated speed
+        expected_eta = (
+            proximity.device_cache['device_tracker.test1'].distance - 10) / (
+            proximity.speed / 3.6) / 60
+        assert abs(proximity.eta - expected_eta) <= 1
+        assert state.attributes.get('eta_minutes') == proximity.eta
+
+    def test_nearest_devices(self):
+        for name, latitude in (('test3', 10.1), ('test4', 30.1)):
+            self.hass.states.set(
+                'device_tracker.' + name, 'not_home',
+                {
+                    'friendly_name': name,
+                    'latitude': latitude,
+                    'longitude': 1.1
+                })
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1', 'device_tracker.test2',
+             'device_tracker.test3', 'device_tracker.test4'], 1,
+            'zone.home', 'home', nearest_count=2)
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+
+        assert proximity.nearest == 'test3'
+        assert [device['nearest'] for device in
+                proximity.nearest_devices] == ['test3', 'test4']
+        assert proximity.nearest_devices[0]['dist_to_zone'] == round(
+            proximity_zones.haversine(2.1, 1.1, 10.1, 1.1) / 1000, 1)
+
+        # only the device that moved is re-sorted
+        proximity.check_proximity_state_change(
+            'device_tracker.test2', None, ha.State(
+                'device_tracker.test2', 'not_home',
+                {'friendly_name': 'test2', 'latitude': 5.1,
+                 'longitude': 1.1}))
+        assert proximity.nearest == 'test2'
+        assert [device['nearest'] for device in
+                proximity.nearest_devices] == ['test2', 'test3']
+        assert len(proximity.nearest_order) == 4
+
+        proximity.check_proximity_state_change(
+            'device_tracker.test4', None, ha.State(
+                'device_tracker.test4', 'home',
+                {'friendly_name': 'test4', 'latitude': 2.1,
+                 'longitude': 1.1}))
+        assert proximity.nearest == 'test4'
+        assert proximity.nearest_devices == [
+            {'nearest': 'test4', 'dist_to_zone': 0},
+            {'nearest': 'test2', 'dist_to_zone': round(
+                proximity_zones.haversine(2.1, 1.1, 5.1, 1.1) / 1000, 1)}]
+        assert len(proximity.nearest_order) == 3
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('nearest_devices') == \
+            proximity.nearest_devices
+
+    def test_fast_distance_within_error(self):
+        geometry = proximity_zones.build_zone_geometry(None, 60, 10, 10)
+        for latitude, longitude in ((60.5, 10.5), (59.9, 11.2), (60, 10),
+                                    (60.01, 9.99)):
+            dist, error = proximity_zones.zone_equirectangular(
+                geometry, latitude, longitude)
+            assert abs(dist - proximity_zones.zone_haversine(
+                geometry, latitude, longitude)) <= error
+
+        # too far away or too close to a pole to approximate
+        assert proximity_zones.zone_equirectangular(geometry, 62, 10) is None
+        assert proximity_zones.zone_equirectangular(
+            proximity_zones.build_zone_geometry(None, 89, 10), 89, 11) is None
+
+    def test_fast_distance_mode_matches_exact(self):
+        exact = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', ['work'],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.home', 'home')
+        exact.entity_id = 'proximity_zones.exact'
+        fast = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', ['work'],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.home', 'home', distance_mode='fast')
+        fast.entity_id = 'proximity_zones.fast'
+        exact.check_proximity_initial_state()
+        fast.check_proximity_initial_state()
+
+        # walk around the edge of the zone and further away, with steps
+        # close to the tolerance
+        rand = random.Random(0)
+        positions = {'device_tracker.test1': (2.1, 1.1),
+                     'device_tracker.test2': (2.2, 1.2)}
+        for step in range(500):
+            entity = rand.choice(sorted(positions))
+            latitude, longitude = positions[entity]
+            scale = rand.choice((0.000005, 0.00001, 0.001, 0.05))
+            latitude += rand.uniform(-scale, scale)
+            longitude += rand.uniform(-scale, scale)
+            if step % 50 == 0:
+                latitude, longitude = 2.1, 1.1 + 0.00009
+            positions[entity] = (latitude, longitude)
+            new_state = ha.State(entity, 'not_home', {
+                'friendly_name': entity.split('.')[1],
+                'latitude': latitude,
+                'longitude': longitude
+            })
+
+            exact.check_proximity_state_change(entity, None, new_state)
+            fast.check_proximity_state_change(entity, None, new_state)
+            assert fast.dist_to == exact.dist_to
+            assert fast.dir_of_travel == exact.dir_of_travel
+            assert fast.nearest == exact.nearest
+            assert fast.nearest_devices == exact.nearest_devices
+
+        assert fast.zone_checks < exact.zone_checks
+
+    def test_proximity_batch_writes_once(self):
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+        self.hass.pool.block_till_done()
+
+        writes = []
+        self.hass.bus.listen(
+            EVENT_STATE_CHANGED,
+            lambda event: writes.append(event)
+            if event.data['entity_id'] == 'proximity_zones.home' else None)
+        proximity.check_proximity_batch([
+            ('device_tracker.test1', ha.State(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': 20.1,
+                 'longitude': 10.1})),
+            ('device_tracker.test2', ha.State(
+                'device_tracker.test2', 'not_home',
+                {'friendly_name': 'test2', 'latitude': 40.1,
+                 'longitude': 20.1})),
+            ('device_tracker.test1', ha.State(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': 10.1,
+                 'longitude': 5.1})),
+            ('device_tracker.test3', ha.State(
+                'device_tracker.test3', 'not_home',
+                {'friendly_name': 'test3', 'latitude': 2.2,
+                 'longitude': 1.1}))
+        ])
+        self.hass.pool.block_till_done()
+
+        assert len(writes) == 1
+        assert proximity.nearest == 'test1'
+        assert proximity.dir_of_travel == 'towards'
+        assert 'device_tracker.test3' not in proximity.device_cache
+
+    def test_engine_batch_window_groups_updates(self):
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'batch_window': 1,
+                'home': {
+                    'zone': 'home',
+                    'devices': {
+                        'test1',
+                        'test2'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+        self.hass.pool.block_till_done()
+        assert self.hass.states.get('proximity_zones.batch_window') is None
+
+        writes = []
+        self.hass.bus.listen(
+            EVENT_STATE_CHANGED,
+            lambda event: writes.append(event)
+            if event.data['entity_id'] == 'proximity_zones.home' else None)
+        for name, latitude in (('test1', 20.1), ('test2', 40.1)):
+            self.hass.states.set(
+                'device_tracker.' + name, 'not_home',
+                {
+                    'friendly_name': name,
+                    'latitude': latitude,
+                    'longitude': 10.1
+                })
+        self.hass.pool.block_till_done()
+        assert not writes
+
+        fire_time_changed(self.hass, dt_util.utcnow() + timedelta(seconds=2))
+        self.hass.pool.block_till_done()
+        assert len(writes) == 1
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('nearest') == 'test1'
+
+    def test_engine_mailbox_drops_superseded_updates(self):
+        engine = proximity_zones.ProximityEngine(self.hass)
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+        engine.add_proximity(proximity)
+
+        # updates wait while the engine is busy
+        engine.working = True
+        for latitude in (40.1, 30.1, 20.1):
+            engine.post_device_update('device_tracker.test1', ha.State(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': latitude,
+                 'longitude': 10.1}))
+        engine.post_device_update('device_tracker.test2', ha.State(
+            'device_tracker.test2', 'not_home',
+            {'friendly_name': 'test2', 'latitude': 50.1,
+             'longitude': 10.1}))
+        assert len(engine.mailbox) == 2
+        assert engine.dropped_updates == 2
+        assert proximity.device_cache['device_tracker.test1'].latitude == 50
+
+        engine.process_mailbox()
+        assert not engine.mailbox
+        assert not engine.working
+        assert proximity.device_cache['device_tracker.test1'].latitude == 20.1
+        assert proximity.nearest == 'test1'
+        assert proximity.dropped_updates == 2
+
+        # an idle engine applies updates straight away
+        engine.post_device_update('device_tracker.test2', ha.State(
+            'device_tracker.test2', 'not_home',
+            {'friendly_name': 'test2', 'latitude': 10.1,
+             'longitude': 10.1}))
+        assert proximity.nearest == 'test2'
+        assert engine.dropped_updates == 2
+
+    def test_position_store(self):
+        for numpy_module in (proximity_zones.np, None):
+            old_numpy_module = proximity_zones.np
+            proximity_zones.np = numpy_module
+            try:
+                positions = proximity_zones.PositionStore(size=2)
+                for index in range(5):
+                    assert positions.update(
+                        'device_tracker.test' + str(index), ha.State(
+                            'device_tracker.test' + str(index), 'not_home',
+                            {'friendly_name': 'test' + str(index),
+                             'latitude': 10 + index,
+                             'longitude': 20 + index})) == index
+                assert len(positions.latitudes) == 8
+                assert positions.update('device_tracker.test3', ha.State(
+                    'device_tracker.test3', 'not_home',
+                    {'friendly_name': 'test3'})) == 3
+                latitudes, longitudes = positions.positions([4, 0])
+            finally:
+                proximity_zones.np = old_numpy_module
+
+            assert positions.names[4] == 'test4'
+            assert positions.position(4) == (14, 24)
+            assert positions.position(3) is None
+            assert list(latitudes) == [14, 10]
+            assert list(longitudes) == [24, 20]
+
+    def test_engine_shares_position_store(self):
+        engine = proximity_zones.ProximityEngine(self.hass)
+        for name in ('home', 'work'):
+            proximity = proximity_zones.Proximity(
+                self.hass, name, 'not set', 'not set', 'not set', [],
+                ['device_tracker.test1', 'device_tracker.test2'], 1,
+                'zone.' + name, name)
+            proximity.entity_id = 'proximity_zones.' + name
+            engine.add_proximity(proximity)
+            proximity.check_proximity_initial_state()
+        assert all(proximity.positions is engine.positions
+                   for proximity in engine.proximities)
+        assert sorted(engine.positions.slots) == ['device_tracker.test1',
+                                                  'device_tracker.test2']
+
+        engine.check_device_state_change(
+            'device_tracker.test1', None, ha.State(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': 20.1,
+                 'longitude': 10.1}))
+        slot = engine.positions.slots['device_tracker.test1']
+        assert engine.positions.position(slot) == (20.1, 10.1)
+        assert engine.proximities[0].nearest == 'test1'
+
+    def test_shared_position_store(self):
+        positions = proximity_zones.PositionStore()
+        positions.update('device_tracker.test1', ha.State(
+            'device_tracker.test1', 'not_home',
+            {'friendly_name': 'test1', 'latitude': 20.1,
+             'longitude': 10.1}))
+        shared = proximity_zones.SharedPositionStore.from_store(positions)
+        attached = proximity_zones.SharedPositionStore(
+            len(shared.latitudes), shared.block_names)
+        try:
+            assert attached.position(0) == (20.1, 10.1)
+            shared.update('device_tracker.test1', ha.State(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': 30.1,
+                 'longitude': 10.1}))
+            assert attached.position(0) == (30.1, 10.1)
+            try:
+                shared.update('device_tracker.test2', None)
+                assert False
+            except ValueError:
+                pass
+        finally:
+            attached.close()
+            shared.close(unlink=True)
+
+    def test_sharded_engine_matches_in_process_engine(self):
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'engine_workers': 2,
+                'home': {
+                    'zone': 'home',
+                    'devices': {
+                        'test1',
+                        'test2'
+                    },
+                    'tolerance': 1
+                },
+                'work': {
+                    'zone': 'work',
+                    'devices': {
+                        'test2'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1', 'device_tracker.test2'], 1,
+            'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.expected'
+        proximity.check_proximity_initial_state()
+
+        for name, latitude in (('test1', 20.1), ('test2', 40.1),
+                               ('test1', 10.1), ('test2', 5.1)):
+            self.hass.states.set(
+                'device_tracker.' + name, 'not_home',
+                {
+                    'friendly_name': name,
+                    'latitude': latitude,
+                    'longitude': 10.1
+                })
+            self.hass.pool.block_till_done()
+            proximity.check_proximity_state_change(
+                'device_tracker.' + name, None,
+                self.hass.states.get('device_tracker.' + name))
+
+            state = self.hass.states.get('proximity_zones.home')
+            assert state.state == str(proximity.dist_to)
+            assert state.attributes.get('nearest') == proximity.nearest
+            assert state.attributes.get('dir_of_travel') == \
+                proximity.dir_of_travel
+        assert state.attributes.get('nearest') == 'test2'
+        assert state.attributes.get('dir_of_travel') == 'towards'
+        assert self.hass.states.get('proximity_zones.work').attributes.get(
+            'nearest') == 'test2'
+
+    def test_sharded_engine_ignores_updates_after_stop(self):
+        engine = proximity_zones.ShardedProximityEngine(self.hass, 0, 2)
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1'], 1, 'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        engine.add_proximity(proximity)
+        engine.check_initial_state()
+        engine.start()
+
+        def move(latitude):
+            """ Move the device through the engine. """
+            engine.post_device_update(
+                'device_tracker.test1', ha.State(
+                    'device_tracker.test1', 'not_home',
+                    {'friendly_name': 'test1', 'latitude': latitude,
+                     'longitude': 1.1}))
+            return self.hass.states.get('proximity_zones.home')
+
+        published = move(20.1).state
+        assert published == str(round(
+            proximity_zones.haversine(2.1, 1.1, 20.1, 1.1) / 1000))
+
+        # stopping twice is harmless, later updates and zone changes are
+        # ignored instead of reaching the freed shared memory
+        engine.stop()
+        engine.stop()
+        assert move(10.1).state == published
+        engine.check_device_batch([('device_tracker.test1', None)])
+        engine.check_zone_state_change('zone.home', None,
+                                       self.hass.states.get('zone.home'))
+        assert engine.mailbox == {}
+        assert not engine.working
+
+    def test_sharded_engine_survives_a_dead_worker(self):
+        def start_engine():
+            """ Start a sharded engine with a proximity on each worker. """
+            engine = proximity_zones.ShardedProximityEngine(self.hass, 0, 2)
+            for name in ('home', 'work'):
+                proximity = proximity_zones.Proximity(
+                    self.hass, name, 'not set', 'not set', 'not set', [],
+                    ['device_tracker.test1'], 1, 'zone.' + name, name)
+                proximity.entity_id = 'proximity_zones.' + name
+                engine.add_proximity(proximity)
+            engine.check_initial_state()
+            engine.start()
+            return engine
+
+        def assert_freed(block_names):
+            """ Check the shared memory blocks have been unlinked. """
+            for block_name in block_names:
+                try:
+                    proximity_zones.shared_memory.SharedMemory(
+                        name=block_name)
+                    assert False
+                except FileNotFoundError:
+                    pass
+
+        engine = start_engine()
+        block_names = engine.positions.block_names
+        engine.processes[0].kill()
+        engine.processes[0].join()
+
+        for latitude in (20.1, 10.1):
+            self.hass.states.set(
+                'device_tracker.test1', 'not_home',
+                {'friendly_name': 'test1', 'latitude': latitude,
+                 'longitude': 1.1})
+            engine.post_device_update(
+                'device_tracker.test1',
+                self.hass.states.get('device_tracker.test1'))
+            state = self.hass.states.get('proximity_zones.home')
+            assert state.state == str(round(
+                proximity_zones.haversine(2.1, 1.1, latitude, 1.1) / 1000))
+        assert state.attributes.get('dir_of_travel') == 'towards'
+        assert self.hass.states.get('proximity_zones.work').attributes.get(
+            'nearest') == 'test1'
+
+        # the workers are stopped and the engine keeps working in process
+        assert engine.in_process
+        assert engine.processes == []
+        assert not engine.working
+        assert_freed(block_names)
+        engine.stop()
+
+        # stopping is best effort when a worker has died
+        engine = start_engine()
+        block_names = engine.positions.block_names
+        processes = engine.processes
+        processes[1].kill()
+        processes[1].join()
+        engine.stop()
+        assert not any(process.is_alive() for process in processes)
+        assert_freed(block_names)
+
+    def test_distance_matrix_matches_scalar_distance(self):
+        zone_table = [
+            proximity_zones.build_zone_geometry('zone.home', 2.1, 1.1),
+            proximity_zones.build_zone_geometry('zone.work', 40.1, -20.1)]
+        latitudes = [20.1 + index for index in range(6)]
+        longitudes = [10.1 - index for index in range(6)]
+        numpy_module = proximity_zones.np
+        matrix = proximity_zones.distance_matrix(zone_table, latitudes,
+                                                 longitudes)
+        proximity_zones.np = None
+        try:
+            scalar_matrix = proximity_zones.distance_matrix(
+                zone_table, latitudes, longitudes)
+        finally:
+            proximity_zones.np = numpy_module
+
+        for row, latitude, longitude in zip(range(6), latitudes,
+                                            longitudes):
+            for column, geometry in enumerate(zone_table):
+                expected = proximity_zones.zone_haversine(
+                    geometry, latitude, longitude)
+                assert abs(matrix[row][column] - expected) < 0.01
+                assert scalar_matrix[row][column] == expected
+
+    def test_setup_writes_each_proximity_once(self):
+        writes = []
+        self.hass.bus.listen(
+            EVENT_STATE_CHANGED,
+            lambda event: writes.append(event.data['entity_id'])
+            if event.data['entity_id'].startswith('proximity_zones.')
+            else None)
+        assert proximity_zones.setup(self.hass, {
+            'proximity_zones': {
+                'home': {
+                    'zone': 'home',
+                    'devices': [
+                        'test1',
+                        'test2'
+                    ],
+                    'tolerance': 1
+                },
+                'work': {
+                    'zone': 'work',
+                    'ignored_zones': {
+                        'home'
+                    },
+                    'devices': {
+                        'test2'
+                    },
+                    'tolerance': 1
+                }
+            }
+        })
+        self.hass.pool.block_till_done()
+
+        assert sorted(writes) == ['proximity_zones.home',
+                                  'proximity_zones.work']
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('nearest') == 'test1'
+        assert state.attributes.get('dir_of_travel') == 'unknown'
+
+    def test_reporting_intervals(self):
+        self.hass.states.set(
+            'device_tracker.test1', 'not_home',
+            {
+                'friendly_name': 'test1',
+                'latitude': 2.101,
+                'longitude': 1.1
+            })
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1', 'device_tracker.test2',
+             'device_tracker.test3'], 1, 'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+
+        # close to the zone or far away and stationary, devices without
+        # coordinates get no recommendation
+        assert proximity.reporting_intervals == {
+            'device_tracker.test1': 30,
+            'device_tracker.test2': 900
+        }
+
+        # moving quickly towards the zone
+        start = dt_util.utcnow()
+        for index, latitude in enumerate((2.25, 2.24, 2.23, 2.22)):
+            proximity.check_proximity_state_change(
+                'device_tracker.test3', None, ha.State(
+                    'device_tracker.test3', 'not_home',
+                    {'friendly_name': 'test3', 'latitude': latitude,
+                     'longitude': 1.1},
+                    last_updated=start + timedelta(minutes=index + 1)))
+        assert proximity.device_cache[
+            'device_tracker.test3'].trend.slope < -15
+        assert proximity.reporting_intervals['device_tracker.test3'] == 300
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.attributes.get('reporting_intervals') == \
+            proximity.reporting_intervals
+
+    def test_zone_margins_stop_flapping(self):
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1'], 1, 'zone.home', 'home',
+            enter_margin=5, exit_margin=5)
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+
+        # meters from the centre of the zone and the expected direction
+        for dist, dir_of_travel in ((9, 'towards'), (11, 'away_from'),
+                                    (4, 'arrived'), (12, 'arrived'),
+                                    (8, 'arrived'), (14, 'arrived'),
+                                    (16, 'away_from'), (9, 'towards')):
+            proximity.check_proximity_state_change(
+                'device_tracker.test1', None, ha.State(
+                    'device_tracker.test1', 'not_home',
+                    {'friendly_name': 'test1',
+                     'latitude': 2.1 + dist / 111195.0,
+                     'longitude': 1.1}))
+            assert proximity.dir_of_travel == dir_of_travel
+
+        # a device short of the entry margin can still be in an ignored zone
+        # inside the monitored zone
+        for name, latitude, radius in (('bighome', 2.1, 1000),
+                                       ('shop', 2.1 + 900 / 111195.0, 50)):
+            self.hass.states.set(
+                'zone.' + name, 'zoning',
+                {
+                    'friendly_name': name,
+                    'latitude': latitude,
+                    'longitude': 1.1,
+                    'radius': radius
+                })
+        proximity = proximity_zones.Proximity(
+            self.hass, 'bighome', 'not set', 'not set', 'not set', ['shop'],
+            ['device_tracker.test1'], 1, 'zone.bighome', 'bighome',
+            enter_margin=200)
+        proximity.entity_id = 'proximity_zones.bighome'
+        assert proximity.zones_inside['zone.bighome'] == frozenset(
+            ['zone.shop'])
+        proximity.check_proximity_initial_state()
+        proximity.check_proximity_state_change(
+            'device_tracker.test1', None, ha.State(
+                'device_tracker.test1', 'shop',
+                {'friendly_name': 'test1',
+                 'latitude': 2.1 + 900 / 111195.0,
+                 'longitude': 1.1}))
+        assert proximity.device_cache['device_tracker.test1'].status == \
+            proximity_zones.DEVICE_IGNORED
+        assert proximity.dist_to == 'not set'
+
+    def test_publication_policy(self):
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1'], 1, 'zone.home', 'home',
+            min_delta=5, min_interval=60)
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+
+        def move(latitude):
+            """ Move the device along the meridian of the zone. """
+            proximity.check_proximity_state_change(
+                'device_tracker.test1', None, ha.State(
+                    'device_tracker.test1', 'not_home',
+                    {'friendly_name': 'test1', 'latitude': latitude,
+                     'longitude': 1.1}))
+            return self.hass.states.get('proximity_zones.home')
+
+        # a change of direction is always published
+        state = move(3.1)
+        assert state.attributes.get('dir_of_travel') == 'towards'
+        published = int(state.state)
+
+        # small or frequent changes are not published
+        state = move(3.09)
+        assert int(state.state) == published
+        state = move(2.9)
+        assert int(state.state) == published
+        assert proximity.suppressed_updates == 2
+
+        # the large change is published once the minimum interval has passed
+        fire_time_changed(self.hass, dt_util.utcnow() + timedelta(seconds=61))
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert int(state.state) == round(
+            proximity_zones.haversine(2.1, 1.1, 2.9, 1.1) / 1000)
+        assert proximity.pending_result is None
+
+        # a pending change is replaced by a later write
+        state = move(2.7)
+        assert proximity.pending_result is not None
+        state = move(2.89)
+        assert state.attributes.get('dir_of_travel') == 'away_from'
+        assert proximity.pending_result is None
+        fire_time_changed(self.hass, dt_util.utcnow() + timedelta(seconds=61))
+        self.hass.pool.block_till_done()
+        state = self.hass.states.get('proximity_zones.home')
+        assert int(state.state) == round(
+            proximity_zones.haversine(2.1, 1.1, 2.89, 1.1) / 1000)
+        assert state.attributes.get('dir_of_travel') == 'away_from'
+
+    def test_deferred_write_does_not_overwrite_a_newer_result(self):
+        started = threading.Event()
+        release = threading.Event()
+        deferred = None
+
+        class HeldProximity(proximity_zones.Proximity):
+            """ Proximity that holds the deferred write. """
+            def write_proximity(self, result):
+                """ Hold the write of the pending result. """
+                if result is deferred:
+                    started.set()
+                    release.wait(5)
+                super().write_proximity(result)
+
+        proximity = HeldProximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', [],
+            ['device_tracker.test1'], 1, 'zone.home', 'home',
+            min_interval=60)
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+        result = proximity.evaluate_proximity()
+
+        deferred = dict(result, dist_to=10)
+        assert not proximity.update_proximity(deferred)
+        assert proximity.pending_result is deferred
+
+        # the timer fires while a course change is being published
+        timer = threading.Thread(target=proximity.publish_pending)
+        timer.start()
+        assert started.wait(5)
+        newer = dict(result, dist_to=5, dir_of_travel='towards')
+        device = threading.Thread(target=proximity.update_proximity,
+                                  args=(newer,))
+        device.start()
+        device.join(0.2)
+        release.set()
+        timer.join(5)
+        device.join(5)
+
+        state = self.hass.states.get('proximity_zones.home')
+        assert state.state == '5'
+        assert state.attributes.get('dir_of_travel') == 'towards'
+        assert proximity.pending_result is None
+        assert not proximity.publish_scheduled
+
+    def test_direction_of_travel_after_leaving_ignored_zone(self):
+        self.hass.states.set(
+            'zone.shop', 'zoning',
+            {
+                'friendly_name': 'shop',
+                'latitude': 20.1,
+                'longitude': 1.1,
+                'radius': 1000
+            })
+        proximity = proximity_zones.Proximity(
+            self.hass, 'home', 'not set', 'not set', 'not set', ['shop'],
+            ['device_tracker.test1'], 1, 'zone.home', 'home')
+        proximity.entity_id = 'proximity_zones.home'
+        proximity.check_proximity_initial_state()
+
+        for latitude in (30.1, 20.1, 20.2):
+            proximity.check_proximity_state_change(
+                'device_tracker.test1', None, ha.State(
+                    'device_tracker.test1', 'not_home',
+                    {'friendly_name': 'test1', 'latitude': latitude,
+                     'longitude': 1.1}))
+        assert proximity.device_cache['device_tracker.test1'].status == \
+            proximity_zones.DEVICE_ELIGIBLE
+
+        # compared with the fix in the shop, not the one before it
+        assert proximity.dir_of_travel == 'away_from'
+
+    def test_fast_distance_mode_through_setup(self):
+        zone_haversine = proximity_zones.zone_haversine
+        zone_equirectangular = proximity_zones.zone_equirectangular
+        calls = {}
+
+        def counting(name, function):
+            """ Count the calls to a distance function. """
+            def counted(*args):
+                """ Count a call and calculate the distance. """
+                calls[name] = calls.get(name, 0) + 1
+                return function(*args)
+            return counted
+
+        results = {}
+        proximity_zones.zone_haversine = counting('exact', zone_haversine)
+        proximity_zones.zone_equirectangular = counting(
+            'fast', zone_equirectangular)
+        try:
+            for mode in ('exact', 'fast'):
+                hass = get_test_home_assistant()
+                zone.setup(hass, {'zone': [{'name': 'home',
+                                            'latitude': 2.1,
+                                            'longitude': 1.1,
+                                            'radius': 10}]})
+                assert proximity_zones.setup(hass, {
+                    'proximity_zones': {
+                        'home': {
+                            'zone': 'home',
+                            'devices': ['test1'],
+                            'tolerance': 1,
+                            'distance_mode': mode
+                        }
+                    }
+                })
+                hass.pool.block_till_done()
+
+                calls.clear()
+                states = []
+                for index in range(20):
+                    hass.states.set(
+                        'device_tracker.test1', 'not_home',
+                        {
+                            'friendly_name': 'test1',
+                            'latitude': 2.2 + index * 0.0123,
+                            'longitude': 1.1
+                        })
+                    hass.pool.block_till_done()
+                    state = hass.states.get('proximity_zones.home')
+                    states.append((state.state,
+                                   state.attributes.get('dir_of_travel')))
+                results[mode] = (dict(calls), states)
+                hass.stop()
+        finally:
+            proximity_zones.zone_haversine = zone_haversine
+            proximity_zones.zone_equirectangular = zone_equirectangular
+
+        # the same states with one approximation instead of one exact
+        # distance per event
+        assert results['fast'][1] == results['exact'][1]
+        assert results['exact'][0] == {'exact': 20}
+        assert results['fast'][0] == {'fast': 20}